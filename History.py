@@ -1,208 +1,591 @@
 import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from itertools import zip_longest
 
+import numpy as np
 import pandas as pd
 import requests
 import streamlit as st
 from pandas import json_normalize
 from streamlit_extras.let_it_rain import rain
 
+import changelog_delta
+import changelog_view
+import db_cache
+import http_client
+import migrations
+import robot_routes
+import scan_metrics
+from migrations import CHANGELOG_COLUMNS, PARAMETER_COLUMNS, content_hash
 
-def read_data_from_db(db_file, table_name):
-    conn = sqlite3.connect(db_file)
-    df = pd.read_sql_query(f"SELECT * FROM {table_name}", conn)
-    conn.close()
-    return df
+# Concurrent scan settings, requests per line controller are capped so a single timer gateway isn't flooded
+SCAN_WORKERS = 16
+PER_HOST_LIMIT = 4
 
+# Fetched schedules decoded together by reformat_batch
+DECODE_BATCH = 64
 
-def fetch_data_from_api(url, data_type, timeout=1):
-    try:
-        response = requests.get(url, timeout=timeout)
-        response.raise_for_status()  # Raises an HTTPError for bad responses (4xx, 5xx)
+# Store changes as deltas with periodic full rows, see changelog_delta.py.
+# Convert the rows already stored with python changelog_delta.py --compact.
+COMPACT_CHANGELOG = False
+
+# Seconds between scan_focus writes for the robot viewed in the page, see scan_daemon.py
+FOCUS_HEARTBEAT = 60
+
+# cProfile dump of a scan started with "Profile the scan"
+SCAN_PROFILE = 'db/scan.prof'
+
+# Schedule numbers a timer can hold, routine scans only request the ones found live before.
+# An empty schedule is checked again by discovery after EMPTY_TTL seconds.
+ALL_SCHEDULES = list(map(str, range(1, 256)))
+EMPTY_TTL = 7 * 24 * 3600
+
+def request_data_from_api(url, data_type, timeout=None, metrics=None):
+    # Like fetch_data_from_api, but a failed request raises instead of returning None
+    with scan_metrics.timer(metrics, 'http', http_client.host_of(url)):
+        response = http_client.get(url, timeout=timeout)
+    response.raise_for_status()  # Raises an HTTPError for bad responses (4xx, 5xx)
+
+    with scan_metrics.timer(metrics, 'json'):
         data = response.json()
 
         # Convert the data to a DataFrame if possible
         df = json_normalize(data, data_type)
 
-        if df.empty:
-            print(f"No data available for {data_type} at {url}")
-            return None
+    if df.empty:
+        print(f"No data available for {data_type} at {url}")
+        return None
+
+    return df
+
 
-        return df
+def fetch_data_from_api(url, data_type, timeout=None):
+    try:
+        return request_data_from_api(url, data_type, timeout=timeout)
 
     except requests.exceptions.RequestException as e:
         print(f"Error fetching data from {url}: {e}")
         return None
 
 
-def fetch_data_from_db(db_file, table_name):
-    conn = sqlite3.connect(db_file)
-    df = pd.read_sql_query(f"SELECT * FROM {table_name}", conn)
-    conn.close()
-    return df
+class ChangelogWriter:
+    # Buffers changed rows and writes them with executemany, one transaction per flush.
+    # Use it as a context manager so pending rows are flushed even if the scan fails.
+
+    def __init__(self, db_file, table_name='changelog', batch_size=500, metrics=None, compact=None):
+        self.metrics = metrics
+        self.table_name = table_name
+        self.compact = COMPACT_CHANGELOG if compact is None else compact
+        self.conn = sqlite3.connect(db_file)
+        # WAL lets the Streamlit pages keep reading while a scan writes
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.columns = CHANGELOG_COLUMNS + ['content_hash', 'changed_mask']
+        self.sql = f'''
+        INSERT INTO {table_name} ({', '.join(self.columns)})
+        VALUES ({', '.join('?' * len(self.columns))})
+        '''
+        self.batch_size = batch_size
+        self.pending = []
+        self.written = 0
+        # Full names of rows another writer had already stored, see new_rows
+        self.duplicates = []
+
+    def add(self, data):
+        # All rows of one call share a timestamp, like a single save_to_db call
+        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        for row in data.to_dict('records'):
+            row['timestamp'] = timestamp
+            if row.get('content_hash') is None:
+                row['content_hash'] = content_hash(row.get(column) for column in PARAMETER_COLUMNS)
+            self.pending.append(tuple(row.get(column) for column in self.columns))
+
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def new_rows(self, rows):
+        # rows whose content differs from the latest row of their schedule, in order. scan_daemon or
+        # another session may have written the same change since the caller loaded its hashes.
+        full_name_index = self.columns.index('full_name')
+        hash_index = self.columns.index('content_hash')
+        full_names = list({row[full_name_index] for row in rows})
+        latest = {}
+        for start in range(0, len(full_names), 500):
+            chunk = full_names[start:start + 500]
+            latest.update(self.conn.execute(f'''
+                SELECT full_name, content_hash FROM {self.table_name}_latest
+                WHERE full_name IN ({', '.join('?' * len(chunk))})
+            ''', chunk))
+
+        kept = []
+        for row in rows:
+            if latest.get(row[full_name_index]) == row[hash_index]:
+                self.duplicates.append(row[full_name_index])
+                continue
+            latest[row[full_name_index]] = row[hash_index]
+            kept.append(row)
+        return kept
+
+    def flush(self):
+        if not self.pending:
+            return
+        with scan_metrics.timer(self.metrics, 'save'), self.conn:
+            # Rows are compared with changelog_latest, and deltas taken against it, while no other
+            # writer can change it
+            self.conn.execute('BEGIN IMMEDIATE')
+            rows = self.new_rows(self.pending)
+            if self.compact:
+                rows = changelog_delta.encode_rows(self.conn, rows, self.columns, self.table_name)
+            self.conn.executemany(self.sql, rows)
+        self.written += len(rows)
+        self.pending = []
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
 
 def save_to_db(db_file, table_name, data):
+    migrations.migrate(db_file)
+    with ChangelogWriter(db_file, table_name) as writer:
+        writer.add(data)
+
+
+def fetch_latest_hashes_from_db(db_file, table_name, robot_names=None):
+    # Content hash of the latest record of every full_name in one query, None loads all robots
     conn = sqlite3.connect(db_file)
-    cursor = conn.cursor()
-    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    sql = f'''
-    INSERT INTO {table_name} (
-        robot_name, schedule, adaptq, stepper, squeeze, preweld_time, preweld_current, cool, slope_up_time,
-        slope_up_from, slope_up_to, impulse_time, impulse_cool, weld_time, weld_current, slope_down_time,
-        slope_down_from, slope_down_to, hold, full_name, timestamp
-    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    where = ''
+    params = ()
+    if robot_names is not None:
+        robot_names = list(robot_names)
+        where = f"WHERE robot_name IN ({', '.join('?' * len(robot_names))})"
+        params = tuple(robot_names)
+    query = f'''
+        SELECT full_name, content_hash FROM {table_name}_latest
+        {where}
     '''
-    for _, row in data.iterrows():
-        parameters = (
-            row.get('robot_name'),
-            row.get('schedule'),
-            row.get('adaptq'),
-            row.get('stepper'),
-            row.get('squeeze'),
-            row.get('preweld_time'),
-            row.get('preweld_current'),
-            row.get('cool'),
-            row.get('slope_up_time'),
-            row.get('slope_up_from'),
-            row.get('slope_up_to'),
-            row.get('impulse_time'),
-            row.get('impulse_cool'),
-            row.get('weld_time'),
-            row.get('weld_current'),
-            row.get('slope_down_time'),
-            row.get('slope_down_from'),
-            row.get('slope_down_to'),
-            row.get('hold'),
-            row.get('full_name'),
-            timestamp
-        )
-        cursor.execute(sql, parameters)
-
-    conn.commit()
+    latest_hashes = dict(conn.execute(query, params).fetchall())
     conn.close()
+    return latest_hashes
 
 
-def fetch_latest_record_from_db(db_file, table_name, full_name):
+def fetch_schedules_from_db(db_file, table_name, robot_name=None):
     conn = sqlite3.connect(db_file)
-    query = f'''
-        SELECT * FROM {table_name}
-        WHERE full_name = ?
-        ORDER BY timestamp DESC LIMIT 1
-    '''
-    df = pd.read_sql_query(query, conn, params=(full_name,))
-    df = df.drop(columns=['full_name', 'timestamp'])
+    if robot_name is None:
+        rows = conn.execute(f"SELECT DISTINCT schedule FROM {table_name}_latest")
+    else:
+        rows = conn.execute(f"SELECT schedule FROM {table_name}_latest WHERE robot_name = ?", (robot_name,))
+    schedules = [row[0] for row in rows]
     conn.close()
-    return df.iloc[0] if not df.empty else None
+    return sorted(schedules)
 
 
-def check_schedule(api_url):
-    update_url = api_url.replace('/schedule', '/history/weld/schedule')
+def fetch_last_scanned(db_file, robot_names):
+    # Last scan and last detected change per robot. Every scan, from this page or scan_daemon, records
+    # the schedules it checked in schedule_inventory and its changes in changelog_latest.
+    robot_names = list(robot_names)
+    placeholders = ', '.join('?' * len(robot_names))
+    conn = sqlite3.connect(db_file)
+    scanned = pd.read_sql_query(f'''
+        SELECT robot_name, datetime(MAX(checked_at), 'unixepoch', 'localtime') AS last_scanned
+        FROM schedule_inventory
+        WHERE robot_name IN ({placeholders})
+        GROUP BY robot_name
+    ''', conn, params=tuple(robot_names))
+    changed = pd.read_sql_query(f'''
+        SELECT robot_name, MAX(timestamp) AS last_changed
+        FROM changelog_latest
+        WHERE robot_name IN ({placeholders})
+        GROUP BY robot_name
+    ''', conn, params=tuple(robot_names))
+    conn.close()
+    return scanned.set_index('robot_name').join(changed.set_index('robot_name'), how='outer').reindex(robot_names)
 
-    df = fetch_data_from_api(update_url, 'history')
-    if df is None:
-        return False
-    elif df.empty:
-        return False
-    else:
-        return True
 
+def mark_focus(db_file, robot_name):
+    # Tells the background scanner someone is viewing this robot, so it's polled more often
+    conn = sqlite3.connect(db_file)
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO scan_focus VALUES (?, ?)", (robot_name, time.time()))
+    conn.close()
 
-def update_db_if_needed(db_file, *, selected_line=None, selected_robot=None):
-    table_name = "changelog"
 
-    line_ips_df = read_data_from_db(db_file, 'line_ips')
+def fetch_inventory(db_file, robot_names=None):
+    # {robot_name: {schedule: (status, checked_at)}}, None loads all robots
+    conn = sqlite3.connect(db_file)
+    where = ''
+    params = ()
+    if robot_names is not None:
+        robot_names = list(robot_names)
+        where = f"WHERE robot_name IN ({', '.join('?' * len(robot_names))})"
+        params = tuple(robot_names)
+    inventory = {}
+    for r, s, status, checked_at in conn.execute(
+            f"SELECT robot_name, schedule, status, checked_at FROM schedule_inventory {where}", params):
+        inventory.setdefault(r, {})[s] = (status, checked_at)
+    conn.close()
+    return inventory
 
-    ips_df = read_data_from_db(db_file, 'ips')
-    line_ips = line_ips_df['ip'].unique()
 
-    if selected_line is not None:
-        scan_line = line_ips_df[line_ips_df['line'].str.startswith(selected_line)]
-        if selected_robot is not None and selected_line == 'FRM1':
-            if int(selected_robot[5]) <= 3:
-                line_ips = pd.Series(scan_line['ip'][2])
-            elif int(selected_robot[5]) > 3:
-                line_ips = pd.Series(scan_line['ip'][3])
-        else:
-            line_ips = scan_line['ip']
+def record_inventory(db_file, rows):
+    # rows are (robot_name, schedule, status, checked_at)
+    if not rows:
+        return
+    conn = sqlite3.connect(db_file)
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO schedule_inventory VALUES (?, ?, ?, ?)", rows)
+    conn.close()
 
-    # Schedule range
-    curstom_range = list(map(str, range(1, 256)))
 
+def routine_schedules(inventory, robot_name, fallback):
+    # Live schedules of a robot, fallback until the robot has been scanned once
+    entries = inventory.get(robot_name)
+    if not entries:
+        return fallback
+    return sorted(s for s, (status, _) in entries.items() if status == 'live')
 
-    # uniqe schedules from db
-    df = fetch_data_from_db(db_file, 'changelog')
-    schedule = sorted(df['schedule'].unique())
 
-    # ------------------------Line loop------------------------------
-    for i, l in enumerate(line_ips):
+def discovery_schedules(inventory, robot_name, now, empty_ttl=EMPTY_TTL):
+    # Schedules never checked on a robot, or found empty longer than empty_ttl ago
+    entries = inventory.get(robot_name, {})
+    return [s for s in ALL_SCHEDULES
+            if s not in entries or (entries[s][0] == 'empty' and entries[s][1] < now - empty_ttl)]
 
-        robot_names = ips_df['robot_name']
 
+def check_schedule(api_url, metrics=None):
+    # Raises on a failed request, so an unreachable timer isn't taken for an empty schedule
+    update_url = api_url.replace('/schedule', '/history/weld/schedule')
 
-        # Matching ip to df
-        filtered_line_ip = line_ips_df[line_ips_df['ip'] == l]
+    df = request_data_from_api(update_url, 'history', metrics=metrics)
+    if df is None:
+        return False
+    elif df.empty:
+        return False
+    else:
+        return True
 
 
+def scan_targets(db_file, selected_line=None, selected_robot=None):
+    # (line ip, robot, schedule url without the number) of the robots to scan, by line controller
+    routes = robot_routes.load(db_file)
+    if selected_robot is not None:
+        route = routes.get(selected_robot)
+        return [] if route is None else [(route['line_ip'], selected_robot, robot_routes.schedule_url(route))]
 
-        # Changing name from FRM1_1 to FRM1
-        if filtered_line_ip['line'].isin(['FRM1_1', 'FRM1_2']).any():
-            filtered_line_name = filtered_line_ip['line'].apply(lambda x: x[:4])
-        else:
-            filtered_line_name = filtered_line_ip['line']
+    return [(route['line_ip'], r, robot_routes.schedule_url(route)) for r, route in routes.items()
+            if selected_line is None or route['group'].startswith(selected_line)]
 
-        filtered_robots = [r for r in robot_names if any(r.startswith(line) for line in filtered_line_name)]
 
+def fetch_schedule(api_url, selected_robot, selected_schedule, probe=True, metrics=None):
+    # Returns raw schedule rows tagged with robot and schedule (or None), number of requests made
+    # and the schedule status, 'live', 'empty' or 'error'
+    request_count = 0
 
-        if filtered_line_ip['line'].isin(['FRM1_1']).any():
-            filtered_robots = [robot for robot in filtered_robots if int(robot[5]) <= 3]
-        elif filtered_line_ip['line'].isin(['FRM1_2']).any():
-            filtered_robots = [robot for robot in filtered_robots if int(robot[5]) > 3]
+    try:
+        if probe:
+            request_count += 1
+            if not check_schedule(api_url, metrics):
+                return None, request_count, 'empty'
 
-        if selected_robot is not None:
-            filtered_robots = pd.Series([selected_robot])
+        request_count += 1
+        api_data = request_data_from_api(api_url, 'schedule', metrics=metrics)
 
-        # -------------------------Robot loop---------------------------
-        for r in filtered_robots:
-            filtered_ip = ips_df[ips_df['robot_name'] == r]
-            selected_ip = filtered_ip['ip'].iloc[0].replace(".", "_")
-            robot_id = filtered_ip['robot_id'].iloc[0]
+    except requests.exceptions.RequestException as e:
+        print(f"Error fetching data from {api_url}: {e}")
+        return None, request_count, 'error'
+
+    if api_data is None:
+        return None, request_count, 'empty'
+
+    # Object dtype keeps every schedule's values as parsed when batches are concatenated
+    return (api_data.astype(object).assign(robot_name=selected_robot, schedule=selected_schedule), request_count,
+            'live')
+
+
+def apply_schedule_changes(writer, api_df, latest_hashes):
+    # latest_hashes maps full_name to the content hash of its latest changelog row and is kept current here
+    if api_df.empty:
+        return []
+
+    api_df['full_name'] = api_df['robot_name'] + api_df['schedule'].astype(str)
+    api_df['content_hash'] = [content_hash(values) for values in
+                              api_df.reindex(columns=PARAMETER_COLUMNS).itertuples(index=False)]
+
+    records_to_update_df = api_df[api_df['content_hash'] != api_df['full_name'].map(latest_hashes)]
+
+    if not records_to_update_df.empty:
+        writer.add(records_to_update_df)
+        latest_hashes.update(zip(records_to_update_df['full_name'], records_to_update_df['content_hash']))
+
+    # Full names of the changed schedules
+    return list(records_to_update_df['full_name'])
+
+
+def interleave_hosts(jobs, host=lambda job: job[0]):
+    # Jobs taken round robin from each host, every host keeps its own order. In host by host order
+    # the workers would all wait on the first host's per_host_limit while the others sit idle.
+    queues = {}
+    for job in jobs:
+        queues.setdefault(host(job), []).append(job)
+    return [job for round_jobs in zip_longest(*queues.values()) for job in round_jobs if job is not None]
+
+
+def scan_jobs(db_file, jobs, latest_hashes, *, workers=0, per_host_limit=PER_HOST_LIMIT, table_name='changelog',
+              progress=None, cancel=None, metrics=None):
+    # jobs are (line ip, robot, schedule url, schedule, probe) tuples, latest_hashes is updated in place.
+    # They run interleaved across line controllers. Workers only fetch, comparing and saving stays on
+    # this thread in that order, so the concurrent scan writes the same rows as the sequential one.
+    # Jobs on a line whose circuit breaker is open are skipped without a request, a failed job
+    # that opened the breaker counts as skipped too.
+    # progress is called with a progress event after every job, setting the cancel event stops
+    # the scan after the fetched schedules are saved.
+    def fetch(job):
+        l, r, api_url, s, probe = job
+        if not http_client.host_available(l):
+            return None, 0, 'skipped'
+        raw_df, request_count, status = fetch_schedule(api_url, r, s, probe, metrics)
+        if status == 'error' and not http_client.host_available(l):
+            status = 'skipped'
+        return raw_df, request_count, status
+
+    jobs = interleave_hosts(jobs)
+    if workers:
+        host_limits = {l: threading.BoundedSemaphore(per_host_limit) for l, *_ in jobs}
+
+        def run(job):
+            with host_limits[job[0]], scan_metrics.profiled_job(metrics):
+                return fetch(job)
+
+        executor = ThreadPoolExecutor(max_workers=workers)
+        results = executor.map(run, jobs)
+    else:
+        executor = None
+        results = map(fetch, jobs)
 
-            selected_url = f"http://{l}/4.1.0/timers/{selected_ip}_{robot_id}/schedule/"
+    stats = {'schedules': len(jobs), 'requests': 0, 'changes': 0, 'changed': [], 'errors': 0,
+             'requests_avoided': sum(not probe for *_, probe in jobs), 'skipped': {}, 'skipped_schedules': [],
+             'cancelled': False}
+    tracker = ScanProgress(jobs, progress)
+    try:
+        with ChangelogWriter(db_file, table_name, metrics=metrics) as writer:
+            pending = []
+            inventory = []
+            checked_at = time.time()
 
             # ---------------------Schedule loop-------------------------
-            for s in schedule:
-                api_url = selected_url + s
+            for (l, r, _, s, _), (raw_df, request_count, status) in zip(jobs, results):
+                stats['requests'] += request_count
+
+                if status == 'error':
+                    stats['errors'] += 1
+
+                if status in ('live', 'empty'):
+                    inventory.append((r, s, status, checked_at))
+
+                if status == 'skipped':
+                    skipped = stats['skipped'].setdefault(l, {'reason': http_client.skip_reason(l), 'robots': [],
+                                                              'schedules': 0})
+                    if r not in skipped['robots']:
+                        skipped['robots'].append(r)
+                    skipped['schedules'] += 1
+                    stats['skipped_schedules'].append(r + str(s))
+
+                if raw_df is not None:
+                    pending.append(raw_df)
+
+                # Decode fetched schedules in batches
+                changed = []
+                if len(pending) >= DECODE_BATCH:
+                    with scan_metrics.timer(metrics, 'decode'):
+                        api_df = reformat_batch(pd.concat(pending, ignore_index=True))
+                    with scan_metrics.timer(metrics, 'diff'):
+                        changed = apply_schedule_changes(writer, api_df, latest_hashes)
+                    stats['changed'] += changed
+                    pending = []
+                    # Someone is watching, make the changes visible right away
+                    if progress is not None:
+                        writer.flush()
+
+                tracker.job_done(l, r, stats, changed)
+
+                if cancel is not None and cancel.is_set():
+                    stats['cancelled'] = True
+                    break
+
+            if pending:
+                with scan_metrics.timer(metrics, 'decode'):
+                    api_df = reformat_batch(pd.concat(pending, ignore_index=True))
+                with scan_metrics.timer(metrics, 'diff'):
+                    changed = apply_schedule_changes(writer, api_df, latest_hashes)
+                stats['changed'] += changed
+                writer.flush()
+                tracker.report(stats, changed)
+
+            record_inventory(db_file, inventory)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+    # Changes another writer stored first aren't this scan's
+    for full_name in writer.duplicates:
+        stats['changed'].remove(full_name)
+    stats['changes'] = len(stats['changed'])
+    return stats
+
+
+class ScanProgress:
+    # Counts finished schedules, robots and lines of a scan and sends progress events,
+    # a robot or line is done once all of its jobs are
+
+    def __init__(self, jobs, callback=None):
+        self.callback = callback
+        self.start = time.perf_counter()
+        self.total = len(jobs)
+        self.done = 0
+        self.robots_left = {}
+        self.lines_left = {}
+        for l, r, *_ in jobs:
+            self.robots_left[r] = self.robots_left.get(r, 0) + 1
+            self.lines_left[l] = self.lines_left.get(l, 0) + 1
+        self.robots = len(self.robots_left)
+        self.lines = len(self.lines_left)
+        self.robots_done = 0
+        self.lines_done = 0
+        self.report({'changed': [], 'errors': 0, 'skipped': {}}, [])
+
+    def job_done(self, l, r, stats, changed):
+        self.done += 1
+        self.robots_left[r] -= 1
+        self.robots_done += self.robots_left[r] == 0
+        self.lines_left[l] -= 1
+        self.lines_done += self.lines_left[l] == 0
+        self.report(stats, changed)
+
+    def report(self, stats, changed):
+        if self.callback is None:
+            return
+        elapsed = time.perf_counter() - self.start
+        self.callback({
+            'schedules_done': self.done,
+            'schedules': self.total,
+            'robots_done': self.robots_done,
+            'robots': self.robots,
+            'lines_done': self.lines_done,
+            'lines': self.lines,
+            'changes': len(stats['changed']),
+            'new_changes': list(changed),
+            'errors': stats['errors'],
+            'skipped': {l: skipped['reason'] for l, skipped in stats['skipped'].items()},
+            'elapsed': elapsed,
+            'eta': elapsed / self.done * (self.total - self.done) if self.done else None,
+        })
+
+
+class ScanTask:
+    # Runs update_db_if_needed on a background thread so the page stays responsive,
+    # the page polls snapshot() and sets cancel to stop the scan
+
+    def __init__(self, db_file, **kwargs):
+        self.cancel = threading.Event()
+        self.lock = threading.Lock()
+        self.progress = None
+        self.changes = []
+        self.stats = None
+        self.error = None
+        self.celebrated = False
+        self.thread = threading.Thread(target=self.run, args=(db_file,), kwargs=kwargs, daemon=True)
+        self.thread.start()
+
+    def run(self, db_file, **kwargs):
+        try:
+            self.stats = update_db_if_needed(db_file, progress=self.update, cancel=self.cancel, **kwargs)
+        except Exception as e:
+            print(f"Scan failed: {e}")
+            self.error = e
+
+    def update(self, event):
+        with self.lock:
+            self.progress = event
+            self.changes += event['new_changes']
+
+    @property
+    def running(self):
+        return self.thread.is_alive()
+
+    def snapshot(self):
+        with self.lock:
+            return self.progress, list(self.changes)
+
+
+def scan_plan(db_file, targets, discover=False, table_name='changelog'):
+    # (line ip, robot, schedule url, schedule) of every schedule to request. Routine scans take the
+    # live schedules of each robot, discover adds the unknown ones and those whose empty entry expired.
+    scan_robots = {r for _, r, _ in targets}
+    inventory = fetch_inventory(db_file, scan_robots)
+
+    # uniqe schedules from db, used for robots missing from the inventory
+    schedule = fetch_schedules_from_db(db_file, table_name)
+    now = time.time()
+
+    plan = []
+    for l, r, selected_url in targets:
+        schedules = routine_schedules(inventory, r, schedule)
+        if discover:
+            schedules = list(dict.fromkeys(schedules + discovery_schedules(inventory, r, now)))
+        plan += [(l, r, selected_url + s, s) for s in schedules]
+    return plan
+
+
+def update_db_if_needed(db_file, *, selected_line=None, selected_robot=None, workers=0,
+                        per_host_limit=PER_HOST_LIMIT, discover=False, progress=None, cancel=None, profile=None):
+    # profile is a path for a cProfile dump of the scan, worker threads included
+    table_name = "changelog"
+    start = time.perf_counter()
+    migrations.migrate(db_file)
+    metrics = scan_metrics.ScanMetrics()
 
-                if not check_schedule(api_url):
-                    continue
+    with scan_metrics.profiled(profile, metrics):
+        with metrics.timer('plan'):
+            targets = scan_targets(db_file, selected_line, selected_robot)
+            plan = scan_plan(db_file, targets, discover, table_name)
 
-                api_data = fetch_data_from_api(api_url, 'schedule')
+            # Content hash of every scanned schedule's latest state, loaded once and compared in memory
+            scan_robots = None if selected_line is None else {r for _, r, _ in targets}
+            latest_hashes = fetch_latest_hashes_from_db(db_file, table_name, scan_robots)
 
-                if api_data is None:
-                    continue
+        # Schedules already in the changelog passed the history check before, for those the
+        # schedule request alone is enough (an empty schedule comes back as None anyway)
+        known_schedules = set(latest_hashes)
 
-                api_df = reformat_df(api_data, r, s)
+        jobs = [(l, r, api_url, s, r + str(s) not in known_schedules) for l, r, api_url, s in plan]
 
-                if not api_df.empty:
-                    api_df['full_name'] = api_df['robot_name'] + str(api_df['schedule'].iloc[0])
-                    api_df = api_df.set_index('full_name')
+        stats = scan_jobs(db_file, jobs, latest_hashes, workers=workers, per_host_limit=per_host_limit,
+                          table_name=table_name, progress=progress, cancel=cancel, metrics=metrics)
 
-                    records_to_update = []
-                    for index, row in api_df.iterrows():
-                        lastest_record = fetch_latest_record_from_db(db_file, 'changelog', index)
-                        if lastest_record is not None:
-                            row = row.reindex(lastest_record.index)
-                            if not row.equals(lastest_record):
-                                records_to_update.append(row)
-                        else:
-                            records_to_update.append(row)
+    stats['wall_time'] = time.perf_counter() - start
+    stats['run_id'] = scan_metrics.save_run(db_file, 'page', stats, metrics)
+    stats['metrics'] = metrics
+    stats['requests_per_second'] = stats['requests'] / stats['wall_time'] if stats['wall_time'] else 0.0
+    stats['pool'] = http_client.pool_stats()
+    print(f"Scanned {stats['schedules']} schedules in {stats['wall_time']:.1f}s, "
+          f"{stats['requests']} requests ({stats['requests_per_second']:.1f}/s, {stats['requests_avoided']} avoided), "
+          f"{stats['changes']} changes, "
+          f"connection pool {stats['pool']['hits']} hits / {stats['pool']['misses']} misses"
+          f"{', cancelled' if stats['cancelled'] else ''}")
+    for l, skipped in stats['skipped'].items():
+        print(f"Skipped {skipped['schedules']} schedules of {len(skipped['robots'])} robots on {l}: {skipped['reason']}")
 
-                    if records_to_update:
-                        records_to_update_df = pd.DataFrame(records_to_update)
-                        records_to_update_df['full_name'] = records_to_update_df['robot_name'] + str(
-                            records_to_update_df['schedule'].iloc[0])
-                        save_to_db(db_file, table_name, records_to_update_df.reset_index())
+    return stats
 
 
 def format_robot_name(robot_name):
@@ -213,163 +596,231 @@ def format_robot_name(robot_name):
     return robot_name
 
 
-def get_function_data(df, func_code, default_value):
-    if isinstance(func_code, str):
-        if df['function'].eq(func_code).any():
-            return df[df['function'].eq(func_code)]
-        else:
-            return default_value
-    elif isinstance(func_code, list):
-        if df['function'].isin(func_code).any():
-            return df[df['function'].isin(func_code)]
-        else:
-            return default_value
-
-
-def format_value(value, suffix='', default=''):
-    if value is not None:
-        return str(value) + suffix
-    return default
-
-
-def reformat_df(schedule_df, selected_robot, selected_schedule):
-    preweld_list = ['22', '23', '24', '32', '33', '34']
-    off = pd.DataFrame(index=range(2))
-    off['param_one'] = None
-    off['param_two'] = None
-    df = pd.DataFrame(index=range(1))
-
-    adaptq = get_function_data(schedule_df, '46', off)
-    stepper = get_function_data(schedule_df, '82', off)
-    squeeze = get_function_data(schedule_df, '1', off)
-    preweld = get_function_data(schedule_df, preweld_list, off)
-    cool = get_function_data(schedule_df, '2', off)
-    slope = get_function_data(schedule_df,'45', off)
-    impuls = get_function_data(schedule_df, '60', off)
-    weld = get_function_data(schedule_df, '30', off)
-    hold = get_function_data(schedule_df, '3', off)
-
-    # Robot name
-    df['robot_name'] = selected_robot
-
-    # Robot schedule
-    df['schedule'] = selected_schedule
+# Function code(s) of every decoded step, the first matching row of a schedule is used
+SCHEDULE_FUNCTIONS = {
+    'adaptq': ['46'],
+    'stepper': ['82'],
+    'squeeze': ['1'],
+    'preweld': ['22', '23', '24', '32', '33', '34'],
+    'cool': ['2'],
+    'slope': ['45'],
+    'impuls': ['60'],
+    'weld': ['30'],
+    'hold': ['3'],
+}
+FUNCTION_STEPS = {code: step for step, codes in SCHEDULE_FUNCTIONS.items() for code in codes}
+SCHEDULE_PARAMS = ['param_one', 'param_two', 'param_three']
+
+
+def format_values(values, suffix=''):
+    # None becomes '', anything else (NaN included) str(value) + suffix
+    values = np.asarray(values, dtype=object)
+    formatted = np.char.add(values.astype(str), suffix).astype(object)
+    formatted[values == None] = ''  # noqa: E711, elementwise on object arrays
+    return formatted
+
+
+def step_params(raw_df, keys, step, occurrence=0):
+    # Params of the n-th row of a step for every (robot_name, schedule) key, None where it's missing
+    rows = raw_df[(raw_df['step'] == step) & (raw_df['occurrence'] == occurrence)]
+    rows = rows.set_index(['robot_name', 'schedule'])
+    present = keys.isin(rows.index)
+    params = rows.reindex(keys)
+    return present, {param: np.where(present, params[param].to_numpy(dtype=object), None)
+                     for param in SCHEDULE_PARAMS}
+
+
+def as_int(values):
+    # int() of every value, NaN where it can't be converted
+    return np.trunc(pd.to_numeric(pd.Series(values, dtype=object), errors='coerce').to_numpy(dtype=float))
+
+
+def reformat_batch(raw_df):
+    # Decodes the raw schedule rows of many robots/schedules at once, raw_df needs robot_name and
+    # schedule columns next to the API columns. One row per schedule, in order of appearance.
+    raw_df = raw_df.reindex(columns=list(dict.fromkeys(['robot_name', 'schedule', 'function'] + SCHEDULE_PARAMS)))
+    raw_df = raw_df.assign(step=raw_df['function'].map(FUNCTION_STEPS))
+    raw_df['occurrence'] = raw_df.groupby(['robot_name', 'schedule', 'step'], sort=False).cumcount()
+
+    df = raw_df[['robot_name', 'schedule']].drop_duplicates().reset_index(drop=True)
+    keys = pd.MultiIndex.from_frame(df)
+
+    _, adaptq = step_params(raw_df, keys, 'adaptq')
+    _, stepper = step_params(raw_df, keys, 'stepper')
+    _, squeeze = step_params(raw_df, keys, 'squeeze')
+    _, preweld = step_params(raw_df, keys, 'preweld')
+    _, cool = step_params(raw_df, keys, 'cool')
+    slope_present, slope = step_params(raw_df, keys, 'slope')
+    slope_down_present, slope_down = step_params(raw_df, keys, 'slope', occurrence=1)
+    _, impuls = step_params(raw_df, keys, 'impuls')
+    _, weld = step_params(raw_df, keys, 'weld')
+    _, hold = step_params(raw_df, keys, 'hold')
 
     # AdaptQ
-    df['adaptq'] = format_value(adaptq.iloc[0]['param_one'])
+    df['adaptq'] = format_values(adaptq['param_one'])
 
     # Stepper
-    df['stepper'] = format_value(stepper.iloc[0]['param_one'])
+    df['stepper'] = format_values(stepper['param_one'])
 
     # Squeeze
-    df['squeeze'] = format_value(squeeze.iloc[0]['param_one'], suffix='ms')
+    df['squeeze'] = format_values(squeeze['param_one'], suffix='ms')
 
     # Pre weld time
-    df['preweld_time'] = format_value(preweld.iloc[0]['param_one'], suffix='ms')
-
-    # Pre weld current
-    preweld_current = preweld.iloc[0]['param_two']
-    if preweld_current is None:
-        df['preweld_current'] = ''
-    elif len(str(preweld_current)) == 2:
-        df['preweld_current'] = format_value(preweld_current, suffix='%')
-    else:
-        df['preweld_current'] = format_value(preweld_current, suffix='0A')
+    df['preweld_time'] = format_values(preweld['param_one'], suffix='ms')
+
+    # Pre weld current, two digits is a percentage
+    preweld_current = preweld['param_two']
+    two_digits = np.char.str_len(preweld_current.astype(str)) == 2
+    df['preweld_current'] = np.where(two_digits, format_values(preweld_current, suffix='%'),
+                                     format_values(preweld_current, suffix='0A'))
 
     # Cool time
-    df['cool'] = format_value(cool.iloc[0]['param_one'], suffix='ms')
-
-    # Slope up
-    if not slope.isnull().all().all():
-        if int(slope.iloc[0]['param_two']) < int(slope.iloc[0]['param_three']):
-            df['slope_up_time'] = format_value(slope.iloc[0]['param_one'], suffix='ms')
-            df['slope_up_from'] = format_value(slope.iloc[0]['param_two'], suffix='0A')
-            df['slope_up_to'] = format_value(slope.iloc[0]['param_three'], suffix='0A')
-        else:
-            df['slope_down_time'] = ''
-            df['slope_down_from'] = ''
-            df['slope_down_to'] = ''
-    else:
-        df['slope_up_time'] = ''
-        df['slope_up_from'] = ''
-        df['slope_up_to'] = ''
+    df['cool'] = format_values(cool['param_one'], suffix='ms')
+
+    # Slope up, a falling first slope leaves the slope up columns unset
+    slope_up = slope_present & (as_int(slope['param_two']) < as_int(slope['param_three']))
+    unset = np.where(slope_present, None, '')
+    df['slope_up_time'] = np.where(slope_up, format_values(slope['param_one'], suffix='ms'), unset)
+    df['slope_up_from'] = np.where(slope_up, format_values(slope['param_two'], suffix='0A'), unset)
+    df['slope_up_to'] = np.where(slope_up, format_values(slope['param_three'], suffix='0A'), unset)
 
     # Impulse time
-    df['impulse_time'] = format_value(impuls.iloc[0]['param_one'])
+    df['impulse_time'] = format_values(impuls['param_one'])
 
     # Impulse cool
-    df['impulse_cool'] = format_value(impuls.iloc[0]['param_two'])
+    df['impulse_cool'] = format_values(impuls['param_two'])
 
-    # Weld time
-    weld_time = weld.iloc[0]['param_one']
-    if weld_time is not None:
-        if len(str(weld_time)) == 1:
-            df['weld_time'] = format_value(weld_time, suffix='x')
-        else:
-            df['weld_time'] = format_value(weld_time, suffix='ms')
-    else:
-        df['weld_time'] = ''
+    # Weld time, a single digit is a cycle count
+    weld_time = weld['param_one']
+    one_digit = np.char.str_len(weld_time.astype(str)) == 1
+    df['weld_time'] = np.where(one_digit, format_values(weld_time, suffix='x'), format_values(weld_time, suffix='ms'))
 
     # Weld current
-    df['weld_current'] = format_value(weld.iloc[0]['param_two'], suffix='0A')
-
-    # Slope down
-    if schedule_df['function'].eq('45').any():
-        if int(slope.iloc[0]['param_two']) > int(slope.iloc[0]['param_three']):
-            df['slope_down_time'] = format_value(slope.iloc[0]['param_one'], suffix='ms')
-            df['slope_down_from'] = format_value(slope.iloc[0]['param_two'], suffix='0A')
-            df['slope_down_to'] = format_value(slope.iloc[0]['param_three'])
-        if slope.shape[0] >= 2:
-            df['slope_down_time'] = format_value(slope.iloc[1]['param_one'], suffix='ms')
-            df['slope_down_from'] = format_value(slope.iloc[1]['param_two'], suffix='0A')
-            df['slope_down_to'] = format_value(slope.iloc[1]['param_three'])
-        else:
-            df['slope_down_time'] = ''
-            df['slope_down_from'] = ''
-            df['slope_down_to'] = ''
-    else:
-        df['slope_down_time'] = ''
-        df['slope_down_from'] = ''
-        df['slope_down_to'] = ''
+    df['weld_current'] = format_values(weld['param_two'], suffix='0A')
 
-    # Hold
-    df['hold'] = format_value(hold.iloc[0]['param_one'], suffix='ms')
+    # Slope down comes from the second slope row
+    df['slope_down_time'] = np.where(slope_down_present, format_values(slope_down['param_one'], suffix='ms'), '')
+    df['slope_down_from'] = np.where(slope_down_present, format_values(slope_down['param_two'], suffix='0A'), '')
+    df['slope_down_to'] = np.where(slope_down_present, format_values(slope_down['param_three']), '')
 
-    df.reset_index(drop=True, inplace=True)
+    # Hold
+    df['hold'] = format_values(hold['param_one'], suffix='ms')
 
     return df
 
 
-def display_data(db_file, fullname):
-    conn = sqlite3.connect(db_file)
-    query = '''
-    SELECT * FROM changelog WHERE full_name = ?
-    '''
-    df = pd.read_sql_query(query, conn, params=(fullname,))
-    df = df.drop(columns='full_name')
-    conn.close()
-    df = df.loc[:, (df != '').any(axis=0)]
-    if df.empty:
-        return st.warning("No data for this schedule")
+def show_skipped(stats):
+    for l, skipped in stats['skipped'].items():
+        st.warning(f"Skipped {l} ({', '.join(skipped['robots'])}): {skipped['reason']}")
+
+
+def show_scan(panel, task):
+    # Progress of a background scan, redrawn until it finishes. Clicking Cancel (or any widget)
+    # reruns the page, the scan itself keeps going on its thread.
+    if task is None:
+        return
+
+    with panel:
+        if task.running and st.button("Cancel scan"):
+            task.cancel.set()
+        status = st.empty()
+        bar = st.empty()
+        changes = st.empty()
+
+    while True:
+        running = task.running
+        event, changed = task.snapshot()
+
+        if event is not None:
+            done = event['schedules_done'] / event['schedules'] if event['schedules'] else 1.0
+            bar.progress(done, text=f"{event['schedules_done']}/{event['schedules']} schedules, "
+                                    f"{event['robots_done']}/{event['robots']} robots, "
+                                    f"{event['lines_done']}/{event['lines']} lines")
+            eta = f", about {event['eta']:.0f}s left" if running and event['eta'] is not None else ''
+            status.write(f"{event['changes']} changes, {event['errors']} errors, "
+                         f"{event['elapsed']:.1f}s{eta}"
+                         f"{' (cancelling)' if task.cancel.is_set() and running else ''}")
+            if changed:
+                changes.dataframe(pd.DataFrame({'Changed schedule': changed}), hide_index=True)
+
+        if not running:
+            break
+        time.sleep(0.25)
+
+    with panel:
+        if task.error is not None:
+            st.error(f"Scan failed: {task.error}")
+            return
+        stats = task.stats
+        if stats['cancelled']:
+            st.warning(f"Cancelled after {stats['wall_time']:.1f}s, {stats['changes']} changes saved")
+        else:
+            st.success(f"Done in {stats['wall_time']:.1f}s ({stats['requests_per_second']:.1f} requests/s), "
+                       f"{stats['changes']} changes")
+        show_skipped(stats)
+
+        # Once per scan
+        if not task.celebrated:
+            print("Scanning for changes finished")
+            task.celebrated = True
+            if not stats['cancelled']:
+                st.balloons()
 
-    return st.write(df.head())
 
-def display_last(db_file):
-    conn = sqlite3.connect(db_file)
-    query = '''
-    SELECT * FROM changelog 
-    ORDER BY timestamp DESC
-    '''
-    df = pd.read_sql_query(query, conn)
-    df = df.drop(columns='full_name')
-    conn.close()
-    df = df.loc[:, (df != '').any(axis=0)]
+def show_scan_performance(db_file):
+    source = st.radio("Scans by", ['page', 'daemon', 'discovery'], horizontal=True)
+    runs = scan_metrics.fetch_runs(db_file, source)
+    if runs.empty:
+        return st.info("No scans recorded yet")
+
+    st.caption("Scan duration (s)")
+    st.line_chart(runs['wall_time'])
+    st.caption("Time per stage (s, summed over workers)")
+    st.bar_chart(runs[scan_metrics.STAGES])
+    st.caption(f"HTTP latency per line of the last scan ({runs['started_at'].iloc[-1]})")
+    st.dataframe(scan_metrics.fetch_hosts(db_file, int(runs.index[-1])), hide_index=True)
+
+
+def date_range(value):
+    # (start, end) of a date_input range, either may be None while it's being picked
+    value = tuple(value) if isinstance(value, (tuple, list)) else (value,)
+    return (value + (None, None))[:2]
+
+
+def show_changelog_page(db_file, key, **filters):
+    # One page of changelog rows, newest first. The page's cursor is kept in session_state[key]
+    # and goes back to the newest page when the filters change.
+    pager = st.session_state.setdefault(key, {'filters': None, 'cursor': None})
+    if pager['filters'] != filters:
+        pager.update(filters=filters, cursor=None)
+
+    df, older, newer = changelog_view.fetch_page(db_file, pager['cursor'], **filters)
     if df.empty:
-        return st.warning("No data for this schedule")
+        st.warning("No changes found")
+    else:
+        st.dataframe(changelog_view.visible_columns(df), hide_index=True)
+
+    newer_column, older_column, newest_column = st.columns(3)
+    cursor = None
+    if newer_column.button("◀ Newer", key=f"{key}_newer", disabled=newer is None):
+        cursor = ('newer', newer)
+    if older_column.button("Older ▶", key=f"{key}_older", disabled=older is None):
+        cursor = ('older', older)
+    if newest_column.button("Newest", key=f"{key}_newest", disabled=pager['cursor'] is None):
+        cursor = 'newest'
+    if cursor is not None:
+        pager['cursor'] = None if cursor == 'newest' else cursor
+        st.rerun()
+
 
-    return st.write(df.head())
+def display_data(db_file, fullname, start_date=None, end_date=None):
+    show_changelog_page(db_file, 'schedule_page', full_name=fullname, start_date=start_date, end_date=end_date)
 
 
+def display_last(db_file, line=None, robot_name=None, start_date=None, end_date=None):
+    show_changelog_page(db_file, 'last_page', line=line, robot_name=robot_name, start_date=start_date,
+                        end_date=end_date)
+
 
 def main():
     st.set_page_config(page_title="Weld History", page_icon="📜", layout="wide")
@@ -379,13 +830,12 @@ def main():
 
     db_file = "db/database.db"
     sw_summary = "sw_summary"
+    migrations.migrate(db_file)
 
-    sw_df = read_data_from_db(db_file, sw_summary)
+    sw_df = db_cache.read_table(db_file, sw_summary)
     sw_df = sw_df.dropna(subset=['Line', 'RobotName'])
     uniq_lines = sw_df['Line'].unique()
 
-    changelog = read_data_from_db(db_file, 'changelog')
-
     # Header
     st.header("Changelog")
 
@@ -406,9 +856,20 @@ def main():
         # Select filtered robot
         selected_robot = st.selectbox("Robot: ", uniq_robots)
 
+        # Focus heartbeat for the scanner, at most once a minute per robot
+        focus = st.session_state.setdefault('scan_focus', {})
+        if selected_robot is not None and time.time() - focus.get(selected_robot, 0) >= FOCUS_HEARTBEAT:
+            mark_focus(db_file, selected_robot)
+            focus[selected_robot] = time.time()
+
+        last_scanned = fetch_last_scanned(db_file, uniq_robots)
+        if selected_robot is not None:
+            scanned = last_scanned.loc[selected_robot, 'last_scanned']
+            st.caption(f"Last scanned: {scanned if isinstance(scanned, str) else 'never'}")
+
         # Select schedule
         schedule_list = list(range(1, 256))
-        schedule_list_upgraded = sorted(changelog['schedule'][changelog['robot_name'] == selected_robot].unique(), key=int)
+        schedule_list_upgraded = sorted(fetch_schedules_from_db(db_file, 'changelog', selected_robot), key=int)
         selected_schedule = st.selectbox("Schedule: ", schedule_list_upgraded)
 
     # Middle column
@@ -417,24 +878,26 @@ def main():
         scan_choice = st.radio("What do you want to scan👇🏼",
                                ["All", "Line", "Robot"])
 
+        # Checks every schedule number instead of the ones known to be in use
+        discover = st.checkbox("Discover new schedules (slow)")
+
+        profile = st.checkbox("Profile the scan (cProfile)")
+
     # Right column
     with right_one:
+        task = st.session_state.get('scan_task')
+        scanning = task is not None and task.running
+        scan_kwargs = None
 
         if scan_choice == "All":
-            if st.button("Scan for changes"):
-                update_db_if_needed(db_file)
-                print("Scanning for changes finished")
-                st.balloons()
-                st.success("Done")
+            if st.button("Scan for changes", disabled=scanning):
+                scan_kwargs = {}
 
         if scan_choice == "Line":
             scan_line = st.selectbox("Select line to scan:", uniq_lines)
 
-            if st.button("Scan for changes"):
-                update_db_if_needed(db_file, selected_line=scan_line)
-                print("Scanning for changes finished")
-                st.balloons()
-                st.success("Done")
+            if st.button("Scan for changes", disabled=scanning):
+                scan_kwargs = {'selected_line': scan_line}
 
         if scan_choice == "Robot":
             scan_line = st.selectbox("Select line to scan:", uniq_lines)
@@ -442,32 +905,57 @@ def main():
             robots_scan_list = sorted(robots_for_scan_line['RobotName'].apply(format_robot_name).unique())
             scan_robot = st.selectbox("Select robot to scan: ", robots_scan_list)
 
-            if st.button("Scan for changes"):
-                update_db_if_needed(db_file, selected_line=scan_line, selected_robot=scan_robot)
-                print("Scanning for changes finished")
-                st.balloons()
-                st.success("Done")
+            if st.button("Scan for changes", disabled=scanning):
+                scan_kwargs = {'selected_line': scan_line, 'selected_robot': scan_robot}
 
+        if scan_kwargs is not None:
+            if profile:
+                scan_kwargs['profile'] = SCAN_PROFILE
+            task = ScanTask(db_file, workers=SCAN_WORKERS, discover=discover, **scan_kwargs)
+            st.session_state['scan_task'] = task
 
+        # Filled in at the end of the page, so the rest of the page renders while the scan runs
+        scan_panel = st.container()
 
     # Display data
     if selected_schedule:
         full_name = selected_robot + str(selected_schedule)
-        display_data(db_file, full_name)
+        schedule_dates = st.date_input("Schedule changes between:", value=(), key='schedule_dates')
+        display_data(db_file, full_name, *date_range(schedule_dates))
 
 
-    # Display last changes
+    # Display last changes, stays open over reruns so its pages can be browsed
     if st.button(f"Last changes"):
-        display_last(db_file)
+        st.session_state['show_last'] = not st.session_state.get('show_last', False)
+
+    if st.session_state.get('show_last'):
+        line_column, robot_column, date_column = st.columns(3)
+        last_line = line_column.selectbox("Changes on line:", ['All', *uniq_lines], key='last_line')
+        last_robots = [] if last_line == 'All' else sorted(
+            sw_df[sw_df['Line'] == last_line]['RobotName'].apply(format_robot_name).unique())
+        last_robot = robot_column.selectbox("Changes of robot:", ['All', *last_robots], key='last_robot')
+        last_dates = date_column.date_input("Changes between:", value=(), key='last_dates')
+        display_last(db_file, None if last_line == 'All' else last_line,
+                     None if last_robot == 'All' else last_robot, *date_range(last_dates))
+
+    with st.expander("Scan performance"):
+        show_scan_performance(db_file)
+
+    with st.sidebar.expander("Last scanned"):
+        st.dataframe(last_scanned.fillna('never'))
+
+    with st.sidebar.expander("Controller health"):
+        st.write(http_client.health_stats())
+
+    with st.sidebar.expander("Cache stats"):
+        st.write(db_cache.stats())
+
+    show_scan(scan_panel, task)
 
 
 
 
-# schedule.every(1).minutes.do(update_db_if_needed, api_url=url, db_file=db_file, table_name=table_name)
-#
-# while True:
-#     schedule.run_pending()
-#     time.sleep(1)
+# Periodic scanning runs in its own process: python scan_daemon.py
 
 
 if __name__ == "__main__":
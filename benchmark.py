@@ -0,0 +1,258 @@
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import History
+import fake_timers
+import migrations
+
+# End to end benchmark against fake_timers.py: generates a database.db, scans it with
+# update_db_if_needed and runs Spot Data searches through Streamlit's AppTest.
+# python benchmark.py --output before.json, then python benchmark.py --compare before.json
+HERE = os.path.dirname(os.path.abspath(__file__))
+MANUFACTURERS = ['KUKA', 'FANUC']
+MATERIALS = ['DC04+DX56', 'HX340+DC04', 'CR4+CR4']
+
+
+def build_database(db_file, lines, base_port, robots_per_line, spots, seed_schedules, config, seed=0):
+    # Line names aren't prefixes of each other, robot names start with their line like on the plant.
+    # Spots use schedules that are live on their robot's fake timer.
+    rnd = random.Random(seed)
+    line_names = [f"L{n:02d}" for n in range(1, lines + 1)]
+    conn = sqlite3.connect(db_file)
+
+    conn.execute("CREATE TABLE line_ips (line TEXT, ip TEXT)")
+    conn.executemany("INSERT INTO line_ips VALUES (?, ?)",
+                     [(line, f"127.0.0.1:{base_port + n}") for n, line in enumerate(line_names)])
+
+    robots = []
+    live_schedules = {}
+    conn.execute("CREATE TABLE ips (robot_name TEXT, ip TEXT, robot_id INTEGER)")
+    for n, line in enumerate(line_names):
+        for r in range(1, robots_per_line + 1):
+            robot = (line, f"{line}{r:03d}RB01", f"10.{n}.{r}.1", 20 + r)
+            timer = f"{robot[2].replace('.', '_')}_{robot[3]}"
+            live_schedules[robot[1]] = [s for s in range(1, 256) if fake_timers.schedule_steps(config, timer, s)]
+            if live_schedules[robot[1]]:
+                robots.append(robot)
+    conn.executemany("INSERT INTO ips VALUES (?, ?, ?)", [robot[1:] for robot in robots])
+
+    conn.execute('CREATE TABLE sw_summary ("Point Name" TEXT, "Line" TEXT, "RobotName" TEXT, "ProgNr" REAL, '
+                 '"Force" REAL, "Part Tolerance" REAL, "PartThickness" TEXT, "Manufacturor" TEXT)')
+    conn.execute("CREATE TABLE thickness (point_id TEXT, total_thk_mat TEXT)")
+    sw_rows = []
+    thickness_rows = []
+    for n in range(spots):
+        line, robot_name, _, _ = rnd.choice(robots)
+        point_name = f"{1500000 + n}-S-{n % 10000:04d}"
+        sw_rows.append((point_name, line, f"{robot_name[:3]}-{robot_name[3:]}SW", rnd.choice(live_schedules[robot_name]),
+                        rnd.choice([2800, 3000, 3200]), 0.2, f"{rnd.randint(15, 40) / 10}".replace('.', ','),
+                        rnd.choice(MANUFACTURERS)))
+        if rnd.random() < 0.8:
+            thickness_rows.append((point_name, f"{rnd.randint(5, 20) / 10}+{rnd.randint(5, 20) / 10}".replace('.', ',')
+                                   + f"//{rnd.choice(MATERIALS)}"))
+    conn.executemany("INSERT INTO sw_summary VALUES (?, ?, ?, ?, ?, ?, ?, ?)", sw_rows)
+    conn.executemany("INSERT INTO thickness VALUES (?, ?)", thickness_rows)
+    conn.execute("CREATE TABLE weld_data (robot_name TEXT, schedule TEXT, ressumd REAL)")
+    conn.execute("INSERT INTO weld_data VALUES ('', '', 0)")
+    conn.commit()
+    conn.close()
+
+    # The scan takes its schedule numbers from the changelog, seeded like an old database
+    migrations.migrate(db_file)
+    conn = sqlite3.connect(db_file)
+    with conn:
+        conn.executemany("INSERT INTO changelog (robot_name, schedule, full_name, timestamp) VALUES (?, ?, ?, ?)",
+                         [(robots[0][1], str(s), robots[0][1] + str(s), '2020-01-01 00:00:00')
+                          for s in range(1, seed_schedules + 1)])
+    conn.close()
+    return [point_name for point_name, *_ in sw_rows]
+
+
+def start_fake_timers(base_port, lines, dead, args):
+    command = [sys.executable, os.path.join(HERE, 'fake_timers.py'), '--base-port', str(base_port),
+               '--lines', str(lines), '--dead', str(dead), '--latency-ms', str(args.latency_ms),
+               '--jitter-ms', str(args.jitter_ms), '--error-rate', str(args.error_rate),
+               '--live-fraction', str(args.live_fraction), '--history-records', str(args.history_records)]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    process.stdout.readline()
+
+    # Wait until the first line answers
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', base_port), timeout=0.1).close()
+            break
+        except OSError:
+            time.sleep(0.05)
+    return process
+
+
+# Peak memory is the process peak RSS so far, or with --memory the peak traced by tracemalloc for the
+# case alone. Tracing slows everything down a lot, so timings of a --memory run aren't comparable.
+TRACE_MEMORY = False
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def measure(function):
+    # (result, seconds, peak MB)
+    if TRACE_MEMORY:
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        result = function()
+    finally:
+        seconds = time.perf_counter() - start
+        if TRACE_MEMORY:
+            peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+            tracemalloc.stop()
+        else:
+            peak = peak_rss_mb()
+    return result, seconds, peak
+
+
+def scan_case(db_file, workers, discover=False):
+    stats, seconds, peak = measure(lambda: History.update_db_if_needed(db_file, workers=workers, discover=discover))
+    latency = stats['metrics'].percentiles('http') or {}
+    return {
+        'seconds': seconds,
+        'schedules': stats['schedules'],
+        'schedules_per_s': stats['schedules'] / seconds,
+        'requests': stats['requests'],
+        'requests_per_s': stats['requests'] / seconds,
+        'changes': stats['changes'],
+        'errors': stats['errors'],
+        'skipped': len(stats['skipped_schedules']),
+        'http_p50_ms': latency.get(50, 0) * 1000,
+        'http_p95_ms': latency.get(95, 0) * 1000,
+        'http_p99_ms': latency.get(99, 0) * 1000,
+        'peak_mb': peak,
+    }
+
+
+def spot_cases(point_names, searches, seed=0):
+    # Searches through the real page, the first run includes materializing spot_data and the index
+    from streamlit.testing.v1 import AppTest
+
+    app = AppTest.from_file(os.path.join(HERE, 'testing.py'), default_timeout=120)
+    rnd = random.Random(seed)
+
+    def search(term):
+        app.text_input[0].input(term).run()
+        if app.exception:
+            raise RuntimeError(app.exception[0].value)
+
+    def first():
+        app.run()
+        search(rnd.choice(point_names))
+
+    _, cold_seconds, cold_peak = measure(first)
+
+    def searches_run():
+        timings = []
+        for _ in range(searches):
+            term = rnd.choice(point_names)
+            start = time.perf_counter()
+            search(term)
+            timings.append(time.perf_counter() - start)
+        return timings
+
+    timings, _, peak = measure(searches_run)
+
+    p50, p95, p99 = np.percentile(timings, [50, 95, 99]) * 1000
+    return {
+        'spot_cold': {'seconds': cold_seconds, 'peak_mb': cold_peak},
+        'spot_search': {'seconds': sum(timings), 'searches': searches, 'searches_per_s': searches / sum(timings),
+                        'p50_ms': p50, 'p95_ms': p95, 'p99_ms': p99, 'peak_mb': peak},
+    }
+
+
+def print_results(results, baseline=None):
+    for case, values in results.items():
+        print(case)
+        for name, value in values.items():
+            line = f"  {name:<16}{value:>12.3f}" if isinstance(value, float) else f"  {name:<16}{value:>12}"
+            old = (baseline or {}).get(case, {}).get(name)
+            if isinstance(old, (int, float)) and old:
+                line += f"   was {old:.3f} ({value / old:.2f}x)"
+            print(line)
+
+
+def run(args):
+    results = {}
+    base_port = args.base_port
+    with tempfile.TemporaryDirectory() as tmp:
+        os.makedirs(os.path.join(tmp, 'db'))
+        db_file = os.path.join(tmp, 'db', 'database.db')
+        config = fake_timers.TimerConfig(args.live_fraction, args.history_records)
+        point_names = build_database(db_file, args.lines, base_port, args.robots, args.spots, args.seed_schedules,
+                                     config)
+        template = os.path.join(tmp, 'template.db')
+        shutil.copy(db_file, template)
+
+        server = start_fake_timers(base_port, args.lines, args.dead, args)
+        cwd = os.getcwd()
+        try:
+            results['scan_cold'] = scan_case(db_file, args.workers)
+            results['scan_warm'] = scan_case(db_file, args.workers)
+            if args.discover:
+                results['scan_discover'] = scan_case(db_file, args.workers, discover=True)
+
+            # The page reads db/database.db relative to the working directory
+            shutil.copy(template, db_file)
+            os.chdir(tmp)
+            if args.searches:
+                results.update(spot_cases(point_names, args.searches))
+        finally:
+            os.chdir(cwd)
+            server.terminate()
+            server.wait()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark scans and spot searches against fake timers")
+    parser.add_argument('--lines', type=int, default=4)
+    parser.add_argument('--dead', type=int, default=0, help="lines without a server")
+    parser.add_argument('--robots', type=int, default=10, help="robots per line")
+    parser.add_argument('--spots', type=int, default=20000)
+    parser.add_argument('--seed-schedules', type=int, default=64, help="schedule numbers in the seeded changelog")
+    parser.add_argument('--live-fraction', type=float, default=0.1)
+    parser.add_argument('--history-records', type=int, default=200)
+    parser.add_argument('--latency-ms', type=float, default=5.0)
+    parser.add_argument('--jitter-ms', type=float, default=2.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--workers', type=int, default=History.SCAN_WORKERS)
+    parser.add_argument('--discover', action='store_true', help="also time a discovery scan over all schedules")
+    parser.add_argument('--searches', type=int, default=50)
+    parser.add_argument('--base-port', type=int, default=8700)
+    parser.add_argument('--memory', action='store_true', help="trace peak memory per case (slow)")
+    parser.add_argument('--output', help="save the results as JSON")
+    parser.add_argument('--compare', help="JSON results of an earlier run to compare with")
+    args = parser.parse_args()
+
+    TRACE_MEMORY = args.memory
+    results = run(args)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,178 @@
+import argparse
+import os
+import sqlite3
+from datetime import datetime, timedelta
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import changelog_delta
+import migrations
+
+# Changelog rows older than ARCHIVE_AFTER_DAYS move out of sqlite into Parquet files next to the
+# database, one directory per month: db/archive/changelog/month=2023-04/<first>-<last rowid>.parquet.
+# The latest row of every schedule stays in sqlite because scans compare against it. Archived rows
+# are full rows (no deltas) that keep their rowid as row_id, changelog_view reads them back when a
+# page reaches into their months.
+#   python changelog_archive.py --days 365
+ARCHIVE_AFTER_DAYS = 365
+
+COMPRESSION = 'zstd'
+
+
+def archive_dir(db_file, table_name='changelog'):
+    return os.path.join(os.path.dirname(os.path.abspath(db_file)), 'archive', table_name)
+
+
+def month_start(month):
+    return f"{month}-01"
+
+
+def next_month(month):
+    year, number = map(int, month.split('-'))
+    return f"{year + number // 12}-{number % 12 + 1:02d}"
+
+
+def archived_months(db_file, table_name='changelog'):
+    # Months with archive files, oldest first
+    root = archive_dir(db_file, table_name)
+    if not os.path.isdir(root):
+        return []
+    return sorted(name[len('month='):] for name in os.listdir(root) if name.startswith('month='))
+
+
+def archive_schema(columns):
+    # Every file of a month gets the same types, even where a column is all NULL
+    return pa.schema([(column, pa.int64() if column == 'row_id' else pa.string()) for column in columns])
+
+
+def key_beyond(df, key, newest_first):
+    # Rows of df past key in reading order
+    timestamp, row_id = key
+    if newest_first:
+        return (df['timestamp'] < timestamp) | ((df['timestamp'] == timestamp) & (df['row_id'] < row_id))
+    return (df['timestamp'] > timestamp) | ((df['timestamp'] == timestamp) & (df['row_id'] > row_id))
+
+
+def read_rows(db_file, filters, newest_first=True, start=None, stop=None, limit=None, table_name='changelog'):
+    # Archived rows matching the changelog_view filters, ordered by (timestamp, row_id) newest or oldest
+    # first, past the key start and not past the key stop, at most limit of them. Only the months in
+    # that range are read, nothing when there's no archive.
+    months = archived_months(db_file, table_name)
+    if newest_first:
+        months.reverse()
+
+    chunks = []
+    found = 0
+    root = archive_dir(db_file, table_name)
+    for month in months:
+        first, end = month_start(month), month_start(next_month(month))
+        if start is not None and (first > start[0] if newest_first else end <= start[0]):
+            continue
+        if stop is not None and (end <= stop[0] if newest_first else first > stop[0]):
+            break
+        if limit is not None and found >= limit:
+            break
+
+        df = pd.read_parquet(os.path.join(root, f"month={month}"), filters=filters or None)
+        if start is not None:
+            df = df[key_beyond(df, start, newest_first)]
+        if stop is not None:
+            df = df[~key_beyond(df, stop, newest_first)]
+        if not df.empty:
+            chunks.append(df)
+            found += len(df)
+
+    if not chunks:
+        return pd.DataFrame()
+    df = pd.concat(chunks, ignore_index=True)
+    df = df.sort_values(['timestamp', 'row_id'], ascending=not newest_first)
+    return df.head(limit).reset_index(drop=True) if limit is not None else df.reset_index(drop=True)
+
+
+def archive_month(conn, db_file, month, cutoff, table_name='changelog'):
+    # Moves the rows of a month older than cutoff to a Parquet file, except each schedule's latest row.
+    # Returns the number of rows moved.
+    df = pd.read_sql_query(f'''
+        SELECT rowid AS row_id, * FROM {table_name} AS archived
+        WHERE timestamp >= ? AND timestamp < ?
+          AND EXISTS (SELECT 1 FROM {table_name} AS newer WHERE newer.full_name = archived.full_name
+                      AND (newer.timestamp, newer.rowid) > (archived.timestamp, archived.rowid))
+        ORDER BY timestamp, rowid
+    ''', conn, params=(month_start(month), min(month_start(next_month(month)), cutoff)))
+    if df.empty:
+        return 0
+
+    # Archived rows are stored in full, so they don't depend on rows elsewhere
+    df = changelog_delta.reconstruct(conn, df, table_name).drop(columns='changed_mask')
+
+    # The row following the archived ones of a schedule becomes a full row for the same reason
+    following = []
+    for full_name, rows in df.groupby('full_name'):
+        row = pd.read_sql_query(f'''
+            SELECT rowid AS row_id, * FROM {table_name}
+            WHERE full_name = ? AND (timestamp, rowid) > (?, ?)
+            ORDER BY timestamp, rowid
+            LIMIT 1
+        ''', conn, params=(full_name, *max(zip(rows['timestamp'], rows['row_id'].astype(int).tolist()))))
+        if not row.empty and pd.notna(row['changed_mask'].iloc[0]):
+            following.append(changelog_delta.reconstruct(conn, row, table_name))
+
+    directory = os.path.join(archive_dir(db_file, table_name), f"month={month}")
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{df['row_id'].min()}-{df['row_id'].max()}.parquet")
+    pq.write_table(pa.Table.from_pandas(df, schema=archive_schema(df.columns), preserve_index=False),
+                   path + '.tmp', compression=COMPRESSION)
+    os.replace(path + '.tmp', path)
+
+    update = f'''
+        UPDATE {table_name} SET {', '.join(f'{column} = ?' for column in migrations.PARAMETER_COLUMNS)},
+        changed_mask = NULL WHERE rowid = ?
+    '''
+    with conn:
+        for row in following:
+            conn.execute(update, (*row[migrations.PARAMETER_COLUMNS].iloc[0], int(row['row_id'].iloc[0])))
+        conn.executemany(f"DELETE FROM {table_name} WHERE rowid = ?", [(int(row_id),) for row_id in df['row_id']])
+    return len(df)
+
+
+def archive(db_file, older_than_days=ARCHIVE_AFTER_DAYS, table_name='changelog'):
+    # Archives month by month, returns {month: rows moved}
+    migrations.migrate(db_file)
+    cutoff = (datetime.now() - timedelta(days=older_than_days)).strftime('%Y-%m-%d %H:%M:%S')
+    conn = sqlite3.connect(db_file)
+    months = [row[0] for row in conn.execute(
+        f"SELECT DISTINCT substr(timestamp, 1, 7) FROM {table_name} WHERE timestamp < ? ORDER BY 1", (cutoff,))]
+
+    moved = {}
+    for month in months:
+        count = archive_month(conn, db_file, month, cutoff, table_name)
+        if count:
+            moved[month] = count
+            print(f"Archived {count} rows of {month}")
+
+    # Hands the freed pages back so the live database shrinks
+    if moved:
+        conn.execute('VACUUM')
+    conn.close()
+    return moved
+
+
+def archive_size(db_file, table_name='changelog'):
+    root = archive_dir(db_file, table_name)
+    return sum(os.path.getsize(os.path.join(directory, name))
+               for directory, _, names in os.walk(root) for name in names)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Move old changelog rows to monthly Parquet files")
+    parser.add_argument('db_file', nargs='?', default='db/database.db')
+    parser.add_argument('--days', type=int, default=ARCHIVE_AFTER_DAYS, help="archive rows older than this")
+    args = parser.parse_args()
+
+    size = os.path.getsize(args.db_file)
+    moved = archive(args.db_file, args.days)
+    print(f"Archived {sum(moved.values())} rows in {len(moved)} months, "
+          f"database {size / 2 ** 20:.2f} MB -> {os.path.getsize(args.db_file) / 2 ** 20:.2f} MB, "
+          f"archive {archive_size(args.db_file) / 2 ** 20:.2f} MB")
@@ -0,0 +1,234 @@
+import argparse
+import os
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+import migrations
+from migrations import PARAMETER_BITS, PARAMETER_COLUMNS
+
+# Compact changelog storage (migration 9). A delta row only stores the parameters that changed since
+# the schedule's previous row, changed_mask has their PARAMETER_BITS set and the other parameter
+# columns are NULL. Rows without a mask hold every parameter, the writer stores such a full row at
+# least every SNAPSHOT_EVERY rows of a schedule so reading one back never walks far.
+#   python changelog_delta.py --compact    converts the existing rows, then set History.COMPACT_CHANGELOG
+#   python changelog_delta.py --expand     converts them back to full rows
+#   python changelog_delta.py              reports how much space the changelog takes
+SNAPSHOT_EVERY = 16
+
+ALL_BITS = sum(PARAMETER_BITS.values())
+
+# Schedules per transaction when converting
+CONVERT_BATCH = 500
+
+
+def same(a, b):
+    # None and NaN are the same missing value
+    if a is None or a != a:
+        return b is None or b != b
+    return a == b
+
+
+def encode(values, previous, deltas):
+    # (stored values, changed_mask) of a row given the full values of the schedule's previous row and
+    # the deltas written since its last full row. previous or deltas None means a full row.
+    if previous is None or deltas is None or deltas >= SNAPSHOT_EVERY - 1:
+        return values, None
+    mask = 0
+    for column, bit in PARAMETER_BITS.items():
+        if not same(values[column], previous[column]):
+            mask |= bit
+    if mask == ALL_BITS:
+        return values, None
+    return {column: None if column in PARAMETER_BITS and not PARAMETER_BITS[column] & mask else value
+            for column, value in values.items()}, mask
+
+
+def latest_state(conn, full_names, table_name='changelog'):
+    # {full_name: (full values, timestamp, deltas)} from the latest table
+    state = {}
+    full_names = list(full_names)
+    for start in range(0, len(full_names), 500):
+        chunk = full_names[start:start + 500]
+        rows = conn.execute(f'''
+            SELECT full_name, timestamp, deltas, {', '.join(PARAMETER_COLUMNS)} FROM {table_name}_latest
+            WHERE full_name IN ({', '.join('?' * len(chunk))})
+        ''', chunk)
+        for full_name, timestamp, deltas, *values in rows:
+            state[full_name] = (dict(zip(PARAMETER_COLUMNS, values)), timestamp, deltas)
+    return state
+
+
+def encode_rows(conn, rows, columns, table_name='changelog'):
+    # Delta encodes the value tuples of a ChangelogWriter batch, columns must include changed_mask.
+    # Call inside the transaction that inserts them.
+    full_name_index = columns.index('full_name')
+    state = latest_state(conn, {row[full_name_index] for row in rows}, table_name)
+
+    encoded = []
+    for row in rows:
+        values = dict(zip(columns, row))
+        previous, timestamp, deltas = state.get(values['full_name'], (None, None, None))
+        # A row older than the latest one can't build on it
+        if timestamp is not None and values['timestamp'] < timestamp:
+            previous = None
+        stored, mask = encode(values, previous, deltas)
+        stored['changed_mask'] = mask
+        encoded.append(tuple(stored[column] for column in columns))
+        state[values['full_name']] = ({column: values[column] for column in PARAMETER_COLUMNS},
+                                      values['timestamp'], 0 if mask is None else deltas + 1)
+    return encoded
+
+
+def fill(df):
+    # Full parameter values of df rows sorted by full_name, timestamp and rowid: every parameter comes
+    # from the last row of the schedule holding it. The first row of a schedule counts as holding all.
+    if df.empty:
+        return df
+    mask = pd.to_numeric(df['changed_mask'], errors='coerce').to_numpy(dtype=float)
+    bits = np.where(np.isnan(mask), ALL_BITS, np.nan_to_num(mask)).astype(np.int64)
+    group_start = (df['full_name'] != df['full_name'].shift()).to_numpy()
+    positions = np.arange(len(df))
+
+    df = df.copy()
+    for column, bit in PARAMETER_BITS.items():
+        holds = (bits & bit).astype(bool) | group_start
+        source = np.maximum.accumulate(np.where(holds, positions, 0))
+        df[column] = df[column].to_numpy(dtype=object)[source]
+    return df
+
+
+def context_rows(conn, full_name, key, table_name='changelog'):
+    # Rows of a schedule before key = (timestamp, rowid), newest first, back to the last full row
+    chunks = []
+    while True:
+        chunk = pd.read_sql_query(f'''
+            SELECT rowid AS row_id, * FROM {table_name}
+            WHERE full_name = ? AND (timestamp, rowid) < (?, ?)
+            ORDER BY timestamp DESC, rowid DESC
+            LIMIT ?
+        ''', conn, params=(full_name, *key, SNAPSHOT_EVERY))
+        chunks.append(chunk.astype({'changed_mask': float}))
+        if chunk.empty or chunk['changed_mask'].isna().any() or len(chunk) < SNAPSHOT_EVERY:
+            break
+        key = (chunk['timestamp'].iloc[-1], int(chunk['row_id'].iloc[-1]))
+    return pd.concat(chunks)
+
+
+def reconstruct(conn, df, table_name='changelog'):
+    # Full rows for a page of changelog rows read with their rowid as row_id. The rows of a schedule
+    # on the page have to be consecutive, as they are on every changelog_view page.
+    if 'changed_mask' not in df.columns or df['changed_mask'].isna().all():
+        return df
+
+    contexts = []
+    for full_name, rows in df.groupby('full_name'):
+        oldest = rows.sort_values(['timestamp', 'row_id']).iloc[0]
+        if pd.notna(oldest['changed_mask']):
+            contexts.append(context_rows(conn, full_name, (oldest['timestamp'], int(oldest['row_id'])), table_name))
+
+    page = df.astype({'changed_mask': float}).assign(_page=np.arange(len(df)))
+    combined = pd.concat([page] + [context.assign(_page=-1) for context in contexts], ignore_index=True)
+    combined = fill(combined.sort_values(['full_name', 'timestamp', 'row_id'], kind='stable'))
+    page = combined[combined['_page'] >= 0].sort_values('_page')
+    return page.drop(columns='_page').set_index(df.index).astype(df.dtypes.to_dict())
+
+
+def rewrite(db_file, compact=True):
+    # Stores every schedule's rows again, as deltas with periodic full rows or all as full rows.
+    # Returns the number of rows changed.
+    migrations.migrate(db_file)
+    conn = sqlite3.connect(db_file)
+    full_names = [row[0] for row in conn.execute("SELECT DISTINCT full_name FROM changelog")]
+    update = f'''
+        UPDATE changelog SET {', '.join(f'{column} = ?' for column in PARAMETER_COLUMNS)}, changed_mask = ?
+        WHERE rowid = ?
+    '''
+
+    changed = 0
+    for start in range(0, len(full_names), CONVERT_BATCH):
+        updates = []
+        latest = []
+        for full_name in full_names[start:start + CONVERT_BATCH]:
+            df = pd.read_sql_query('''
+                SELECT rowid AS row_id, * FROM changelog WHERE full_name = ? ORDER BY timestamp, rowid
+            ''', conn, params=(full_name,))
+            full = fill(df)
+
+            previous = None
+            deltas = None
+            for stored_row, full_row in zip(df.to_dict('records'), full.to_dict('records')):
+                values = {column: full_row[column] for column in PARAMETER_COLUMNS}
+                stored, mask = encode(values, previous, deltas) if compact else (values, None)
+                old_mask = None if pd.isna(stored_row['changed_mask']) else int(stored_row['changed_mask'])
+                if mask != old_mask or any(not same(stored[column], stored_row[column])
+                                           for column in PARAMETER_COLUMNS):
+                    updates.append((*(stored[column] for column in PARAMETER_COLUMNS), mask, int(stored_row['row_id'])))
+                previous = values
+                deltas = 0 if mask is None else deltas + 1
+            latest.append((deltas, full_name))
+
+        with conn:
+            conn.executemany(update, updates)
+            conn.executemany("UPDATE changelog_latest SET deltas = ? WHERE full_name = ?", latest)
+        changed += len(updates)
+
+    # Deltas leave free space in the pages, VACUUM gives it back to the file system
+    conn.execute('VACUUM')
+    conn.close()
+    return changed
+
+
+def size_report(db_file):
+    # Rows, parameter values and bytes stored in the changelog. Table and index bytes come from dbstat
+    # and are None when sqlite is built without it.
+    conn = sqlite3.connect(db_file)
+    stored = ' + '.join(f'({column} IS NOT NULL)' for column in PARAMETER_COLUMNS)
+    lengths = ' + '.join(f'COALESCE(LENGTH({column}), 0)' for column in PARAMETER_COLUMNS)
+    row = conn.execute(f'''
+        SELECT COUNT(*), COUNT(changed_mask), COALESCE(SUM({stored}), 0), COALESCE(SUM({lengths}), 0)
+        FROM changelog
+    ''').fetchone()
+    report = dict(zip(['rows', 'delta_rows', 'stored_parameters', 'parameter_bytes'], row))
+    try:
+        report['table_bytes'], report['index_bytes'] = conn.execute('''
+            SELECT SUM(CASE WHEN name = 'changelog' THEN pgsize END), SUM(CASE WHEN name != 'changelog' THEN pgsize END)
+            FROM dbstat
+            WHERE name IN (SELECT name FROM sqlite_schema WHERE tbl_name = 'changelog')
+        ''').fetchone()
+    except sqlite3.OperationalError:
+        report['table_bytes'] = report['index_bytes'] = None
+    conn.close()
+    report['file_bytes'] = os.path.getsize(db_file)
+    return report
+
+
+def print_report(report, before=None):
+    print(f"changelog rows: {report['rows']}, delta rows: {report['delta_rows']}, "
+          f"stored parameters: {report['stored_parameters']} of {report['rows'] * len(PARAMETER_COLUMNS)}")
+    for name in ('parameter_bytes', 'table_bytes', 'index_bytes', 'file_bytes'):
+        if report[name] is None:
+            continue
+        line = f"  {name:<16}{report[name] / 2 ** 20:>10.2f} MB"
+        if before is not None and before[name]:
+            line += f"   was {before[name] / 2 ** 20:.2f} MB ({report[name] / before[name] - 1:+.0%})"
+        print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert the changelog between full and delta rows")
+    parser.add_argument('db_file', nargs='?', default='db/database.db')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--compact', action='store_true', help="store changes as deltas with periodic full rows")
+    mode.add_argument('--expand', action='store_true', help="store every change as a full row again")
+    args = parser.parse_args()
+
+    migrations.migrate(args.db_file)
+    before = size_report(args.db_file)
+    if args.compact or args.expand:
+        changed = rewrite(args.db_file, compact=args.compact)
+        print(f"Rewrote {changed} rows")
+        print_report(size_report(args.db_file), before)
+    else:
+        print_report(before)
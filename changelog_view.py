@@ -0,0 +1,112 @@
+import sqlite3
+from datetime import timedelta
+
+import pandas as pd
+
+import changelog_archive
+import changelog_delta
+
+# Keyset pagination over changelog, newest first. A page is addressed by the (timestamp, rowid) of
+# the row it continues from, so every page costs one indexed query of page_size + 1 rows however
+# large the table gets. Pages reaching back into archived months also read those, see changelog_archive.py.
+PAGE_SIZE = 20
+
+HIDDEN_COLUMNS = ['row_id', 'full_name', 'content_hash', 'changed_mask']
+
+
+def prefix_range(prefix):
+    # (low, high) with low <= text < high for every text starting with prefix, usable by an index
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def filter_conditions(full_name=None, line=None, robot_name=None, start_date=None, end_date=None):
+    # (column, operator, value) for the filters that are set, dates are inclusive. The same list
+    # filters the Parquet files of the archive.
+    conditions = []
+    if full_name is not None:
+        conditions.append(('full_name', '==', full_name))
+    if robot_name is not None:
+        conditions.append(('robot_name', '==', robot_name))
+    elif line is not None:
+        # Robot names start with their line, FRM2010RB01 is on FRM2
+        low, high = prefix_range(line)
+        conditions += [('robot_name', '>=', low), ('robot_name', '<', high)]
+    if start_date is not None:
+        conditions.append(('timestamp', '>=', start_date.strftime('%Y-%m-%d')))
+    if end_date is not None:
+        conditions.append(('timestamp', '<', (end_date + timedelta(days=1)).strftime('%Y-%m-%d')))
+    return conditions
+
+
+def sql_column(column, operator):
+    # A line is a robot_name range. Served by the robot_name index every page would sort all rows of the
+    # line, +robot_name keeps sqlite walking the timestamp index and checking the range row by row.
+    return f"+{column}" if column == 'robot_name' and operator != '==' else column
+
+
+def filter_sql(conditions):
+    # WHERE conditions and params for filter_conditions
+    return ([f"{sql_column(column, operator)} {'=' if operator == '==' else operator} ?"
+             for column, operator, _ in conditions],
+            [value for _, _, value in conditions])
+
+
+def row_key(row):
+    return row['timestamp'], int(row['row_id'])
+
+
+def fetch_page(db_file, cursor=None, page_size=PAGE_SIZE, table_name='changelog', **filters):
+    # cursor is None for the newest page, ('older', key) for the page after the row key or
+    # ('newer', key) for the page before it. Returns (df, older key or None, newer key or None),
+    # a key is (timestamp, rowid) and None means there's no such page.
+    filters = filter_conditions(**filters)
+    conditions, params = filter_sql(filters)
+    direction = None if cursor is None else cursor[0]
+    if direction == 'older':
+        conditions.append("(timestamp, rowid) < (?, ?)")
+        params += cursor[1]
+    elif direction == 'newer':
+        conditions.append("(timestamp, rowid) > (?, ?)")
+        params += cursor[1]
+
+    order = 'ASC' if direction == 'newer' else 'DESC'
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    query = f'''
+        SELECT rowid AS row_id, * FROM {table_name}
+        {where}
+        ORDER BY timestamp {order}, rowid {order}
+        LIMIT ?
+    '''
+    conn = sqlite3.connect(db_file)
+    df = pd.read_sql_query(query, conn, params=params + [page_size + 1])
+    df = changelog_delta.reconstruct(conn, df, table_name)
+    conn.close()
+
+    # Archived rows only make it onto the page when the live rows don't fill it or reach back past them
+    stop = row_key(df.iloc[-1]) if len(df) > page_size else None
+    archived = changelog_archive.read_rows(db_file, filters, newest_first=direction != 'newer',
+                                           start=None if cursor is None else cursor[1], stop=stop,
+                                           limit=page_size + 1, table_name=table_name)
+    if not archived.empty:
+        df = pd.concat([df, archived], ignore_index=True) if not df.empty else archived
+        df = df.sort_values(['timestamp', 'row_id'], ascending=direction == 'newer').reset_index(drop=True)
+
+    more = len(df) > page_size
+    df = df.head(page_size)
+    if direction == 'newer':
+        df = df.iloc[::-1].reset_index(drop=True)
+    if df.empty:
+        return df, None, None
+
+    first = row_key(df.iloc[0])
+    last = row_key(df.iloc[-1])
+    if direction == 'newer':
+        # Came back from an older page, so there is one
+        return df, last, first if more else None
+    return df, last if more else None, first if direction == 'older' else None
+
+
+def visible_columns(df):
+    # Drops bookkeeping columns and parameters that are empty on the whole page
+    df = df.drop(columns=[column for column in HIDDEN_COLUMNS if column in df.columns])
+    return df.loc[:, (df != '').any(axis=0)]
@@ -0,0 +1,105 @@
+import os
+import sqlite3
+import threading
+import time
+
+import pandas as pd
+
+import spot_data
+
+# Process wide, so cached tables survive Streamlit reruns and are shared between sessions.
+# Cached values are shared, callers must not modify them in place. _lock guards the dicts, a value
+# is loaded under the lock of its key only, so a slow loader doesn't hold up other lookups.
+_lock = threading.RLock()
+_key_locks = {}
+_connections = {}
+_cache = {}
+_stats = {'hits': 0, 'misses': 0, 'load_time': 0.0, 'loads': {}}
+
+
+def data_version(db_file):
+    # PRAGMA data_version changes when any other connection commits to the database,
+    # mtime and inode catch the file itself being replaced
+    stat = os.stat(db_file)
+    conn, inode = _connections.get(db_file, (None, None))
+    if conn is None or inode != stat.st_ino:
+        if conn is not None:
+            conn.close()
+        conn = sqlite3.connect(db_file, check_same_thread=False)
+        _connections[db_file] = (conn, stat.st_ino)
+
+    version = conn.execute('PRAGMA data_version').fetchone()[0]
+    return version, stat.st_mtime_ns, stat.st_ino
+
+
+def table_version(db_file, tables):
+    # Changes only when one of tables does, counted by the change triggers spot_data uses for its
+    # sources. The triggers go in before the fingerprint is taken, the first run would otherwise
+    # cache the value under a key their installation changes.
+    conn = sqlite3.connect(db_file)
+    try:
+        if not spot_data.has_change_triggers(conn, tables):
+            with conn:
+                spot_data.ensure_change_triggers(conn, tables)
+        return spot_data.source_fingerprint(conn, tables)
+    finally:
+        conn.close()
+
+
+def load(db_file, key, loader, version=None):
+    # version overrides the database wide data_version for values that depend on only a few tables
+    with _lock:
+        if version is None:
+            version = data_version(db_file)
+        entry = _cache.get((db_file, key))
+        if entry is not None and entry[0] == version:
+            _stats['hits'] += 1
+            return entry[1]
+        key_lock = _key_locks.setdefault((db_file, key), threading.Lock())
+
+    with key_lock:
+        # Another session may have loaded it while this one waited
+        with _lock:
+            entry = _cache.get((db_file, key))
+            if entry is not None and entry[0] == version:
+                _stats['hits'] += 1
+                return entry[1]
+
+        start = time.perf_counter()
+        value = loader()
+        load_time = time.perf_counter() - start
+
+        with _lock:
+            _stats['misses'] += 1
+            _stats['load_time'] += load_time
+            _stats['loads'][str(key)] = round(load_time, 4)
+            _cache[(db_file, key)] = (version, value)
+        return value
+
+
+def read_table(db_file, table_name):
+    # Reloaded when table_name changes, not on every write to the database
+    def loader():
+        conn = sqlite3.connect(db_file)
+        df = pd.read_sql_query(f"SELECT * FROM {table_name}", conn)
+        conn.close()
+        return df
+
+    return load(db_file, table_name, loader, version=table_version(db_file, (table_name,)))
+
+
+def stats():
+    with _lock:
+        total = _stats['hits'] + _stats['misses']
+        return {
+            'hits': _stats['hits'],
+            'misses': _stats['misses'],
+            'hit_rate': _stats['hits'] / total if total else 0.0,
+            'load_time': round(_stats['load_time'], 4),
+            'loads': dict(_stats['loads']),
+        }
+
+
+def clear():
+    with _lock:
+        _cache.clear()
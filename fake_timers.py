@@ -0,0 +1,148 @@
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Local stand-in for the line controllers, one HTTP server per line on its own port. Serves
+#   /4.1.0/timers/{ip}_{id}/schedule/N               {"schedule": [...]}
+#   /4.1.0/timers/{ip}_{id}/history/weld/schedule/N  {"history": [...]}
+# Payloads are derived from the timer key and schedule number, so every run serves the same data.
+
+TIMER_PATH = re.compile(r"/4\.1\.0/timers/([^/]+)/(history/weld/)?schedule/(\d+)/?$")
+
+
+class TimerConfig:
+
+    def __init__(self, live_fraction=0.1, history_records=200, latency_ms=5.0, jitter_ms=2.0, error_rate=0.0,
+                 change_rate=0.0, seed=0):
+        self.live_fraction = live_fraction
+        self.history_records = history_records
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.change_rate = change_rate
+        self.seed = seed
+
+
+def timer_random(config, *parts):
+    return random.Random(zlib.crc32(':'.join(map(str, (config.seed,) + parts)).encode()))
+
+
+def schedule_steps(config, timer, schedule):
+    # Function rows as the timers return them, [] for an unused schedule
+    rnd = timer_random(config, timer, schedule)
+    if rnd.random() >= config.live_fraction:
+        return []
+
+    steps = [{"function": "1", "param_one": rnd.choice([100, 150, 200])},
+             {"function": rnd.choice(["22", "32"]), "param_one": 40, "param_two": rnd.choice([55, 800])},
+             {"function": "2", "param_one": 20},
+             {"function": "45", "param_one": 10, "param_two": 500, "param_three": 800},
+             {"function": "30", "param_one": rnd.choice([3, 250, 300]), "param_two": rnd.choice([850, 900, 950])},
+             {"function": "45", "param_one": 12, "param_two": 800, "param_three": 400},
+             {"function": "3", "param_one": 150}]
+    if rnd.random() < 0.3:
+        steps.insert(4, {"function": "60", "param_one": 50, "param_two": 10})
+    if rnd.random() < 0.3:
+        steps.insert(0, {"function": "46", "param_one": 1})
+    if rnd.random() < 0.2:
+        steps.insert(0, {"function": "82", "param_one": rnd.randint(1, 4)})
+
+    # A changed schedule, the weld current moved
+    if config.change_rate and random.random() < config.change_rate:
+        steps = [dict(step) for step in steps]
+        weld = next(step for step in steps if step["function"] == "30")
+        weld["param_two"] += random.choice([-10, 10])
+    return steps
+
+
+def history_records(config, timer, schedule):
+    # Newest weld first, empty when the schedule isn't used
+    if not schedule_steps(config, timer, schedule):
+        return []
+    rnd = timer_random(config, timer, schedule, 'history')
+    base = rnd.uniform(80, 140)
+    start = 1_700_000_000
+    return [{"weldid": config.history_records - i,
+             "timestamp": start + (config.history_records - i) * 60,
+             "ressumd": round(base + rnd.gauss(0, 4), 2),
+             "turnsratio": 55,
+             "current": rnd.randint(8500, 9500),
+             "weldtime": rnd.randint(240, 260)}
+            for i in range(config.history_records)]
+
+
+class TimerHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    config = TimerConfig()
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        config = self.config
+        if config.latency_ms or config.jitter_ms:
+            time.sleep(max(0.0, random.gauss(config.latency_ms, config.jitter_ms)) / 1000)
+
+        match = TIMER_PATH.match(self.path)
+        if match is None:
+            return self.respond(404, {})
+        if config.error_rate and random.random() < config.error_rate:
+            return self.respond(500, {"error": "injected"})
+
+        timer, history, schedule = match.group(1), match.group(2), int(match.group(3))
+        if history:
+            return self.respond(200, {"history": history_records(config, timer, schedule)})
+        return self.respond(200, {"schedule": schedule_steps(config, timer, schedule)})
+
+    def respond(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(ports, config, host='127.0.0.1'):
+    # Starts one server per port on daemon threads, returns the servers
+    handler = type('Handler', (TimerHandler,), {'config': config})
+    servers = []
+    for port in ports:
+        server = ThreadingHTTPServer((host, port), handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+    return servers
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve fake timer controllers, one port per line")
+    parser.add_argument('--base-port', type=int, default=8700)
+    parser.add_argument('--lines', type=int, default=4)
+    parser.add_argument('--dead', type=int, default=0, help="last N lines get no server (connection refused)")
+    parser.add_argument('--live-fraction', type=float, default=0.1, help="share of schedules in use")
+    parser.add_argument('--history-records', type=int, default=200)
+    parser.add_argument('--latency-ms', type=float, default=5.0)
+    parser.add_argument('--jitter-ms', type=float, default=2.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--change-rate', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    config = TimerConfig(args.live_fraction, args.history_records, args.latency_ms, args.jitter_ms,
+                         args.error_rate, args.change_rate, args.seed)
+    ports = [args.base_port + n for n in range(args.lines - args.dead)]
+    serve(ports, config)
+    print(f"Serving {len(ports)} lines on ports {ports[0] if ports else '-'}..{ports[-1] if ports else '-'}",
+          flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
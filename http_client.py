@@ -0,0 +1,166 @@
+import statistics
+import threading
+import time
+from collections import deque
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Timeout policy for all timer API calls (connect, read)
+TIMEOUT = (1, 1)
+
+# Connections kept alive per line controller and how many controllers are pooled
+POOL_MAXSIZE = 8
+POOL_HOSTS = 32
+
+# Retry with backoff on connection errors and gateway errors, 0.2s, 0.4s...
+RETRY = Retry(
+    total=2,
+    connect=2,
+    read=1,
+    backoff_factor=0.2,
+    status_forcelist=(502, 503, 504),
+    allowed_methods=frozenset(['GET']),
+    raise_on_status=False,
+)
+
+# Circuit breaker, a host failing FAILURE_THRESHOLD requests in a row is skipped for COOL_DOWN seconds
+FAILURE_THRESHOLD = 3
+COOL_DOWN = 60
+
+# Adaptive timeouts, TIMEOUT_FACTOR x the p95 latency of the last LATENCY_SAMPLES responses of a host,
+# between MIN_TIMEOUT and TIMEOUT
+LATENCY_SAMPLES = 50
+MIN_SAMPLES = 10
+TIMEOUT_FACTOR = 4
+MIN_TIMEOUT = 0.2
+
+_session = None
+_lock = threading.Lock()
+_health = {}
+
+
+class HostUnavailable(requests.exceptions.ConnectionError):
+    pass
+
+
+class HostHealth:
+
+    def __init__(self):
+        self.failures = 0
+        self.open_until = 0.0
+        self.last_error = None
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+
+
+def get_session():
+    global _session
+    with _lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=POOL_HOSTS, pool_maxsize=POOL_MAXSIZE, max_retries=RETRY)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session = session
+    return _session
+
+
+def host_of(url):
+    return urlsplit(url).netloc
+
+
+def _host_health(host):
+    with _lock:
+        health = _health.get(host)
+        if health is None:
+            health = _health[host] = HostHealth()
+        return health
+
+
+def host_available(host):
+    # False while the breaker of host is open
+    return _host_health(host).open_until <= time.monotonic()
+
+
+def skip_reason(host):
+    health = _host_health(host)
+    return f"{health.failures} failures in a row, last: {health.last_error}"
+
+
+def adaptive_timeout(host):
+    # TIMEOUT until enough latencies are known
+    latencies = list(_host_health(host).latencies)
+    if len(latencies) < MIN_SAMPLES:
+        return TIMEOUT
+    p95 = statistics.quantiles(latencies, n=20)[-1]
+    return tuple(min(limit, max(MIN_TIMEOUT, p95 * TIMEOUT_FACTOR)) for limit in TIMEOUT)
+
+
+def record_success(host, latency):
+    health = _host_health(host)
+    with _lock:
+        health.failures = 0
+        health.latencies.append(latency)
+
+
+def record_failure(host, error):
+    health = _host_health(host)
+    with _lock:
+        health.failures += 1
+        health.last_error = str(error)
+        if health.failures >= FAILURE_THRESHOLD:
+            health.open_until = time.monotonic() + COOL_DOWN
+
+
+def get(url, timeout=None):
+    host = host_of(url)
+    if not host_available(host):
+        raise HostUnavailable(f"{host} skipped, {skip_reason(host)}")
+    if timeout is None:
+        timeout = adaptive_timeout(host)
+
+    start = time.perf_counter()
+    try:
+        response = get_session().get(url, timeout=timeout)
+    except requests.exceptions.RequestException as e:
+        record_failure(host, type(e).__name__)
+        raise
+
+    # A 4xx is an answer from a healthy controller, 5xx left after the retries is not
+    if response.status_code >= 500:
+        record_failure(host, f"HTTP {response.status_code}")
+    else:
+        record_success(host, time.perf_counter() - start)
+    return response
+
+
+def health_stats():
+    with _lock:
+        hosts = dict(_health)
+    return {host: {'failures': health.failures,
+                   'available': host_available(host),
+                   'timeout': adaptive_timeout(host),
+                   'last_error': health.last_error}
+            for host, health in hosts.items()}
+
+
+def pool_stats():
+    # A hit is a request sent over an already open connection, a miss had to open a new one
+    stats = {'hits': 0, 'misses': 0, 'hosts': {}}
+    session = get_session()
+
+    for adapter in set(session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            misses = pool.num_connections
+            hits = max(pool.num_requests - misses, 0)
+            stats['hosts'][f"{pool.host}:{pool.port}"] = {'hits': hits, 'misses': misses}
+            stats['hits'] += hits
+            stats['misses'] += misses
+
+    return stats
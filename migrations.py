@@ -0,0 +1,352 @@
+import argparse
+import hashlib
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+CHANGELOG_COLUMNS = [
+    'robot_name', 'schedule', 'adaptq', 'stepper', 'squeeze', 'preweld_time', 'preweld_current', 'cool',
+    'slope_up_time', 'slope_up_from', 'slope_up_to', 'impulse_time', 'impulse_cool', 'weld_time', 'weld_current',
+    'slope_down_time', 'slope_down_from', 'slope_down_to', 'hold', 'full_name', 'timestamp'
+]
+
+# Decoded weld parameters, the part of a row that content_hash covers
+PARAMETER_COLUMNS = CHANGELOG_COLUMNS[2:19]
+
+# Bits of changelog.changed_mask, see changelog_delta.py
+PARAMETER_BITS = {column: 1 << n for n, column in enumerate(PARAMETER_COLUMNS)}
+
+_columns = ', '.join(CHANGELOG_COLUMNS)
+_new_values = ', '.join(f'NEW.{column}' for column in CHANGELOG_COLUMNS)
+
+
+def content_hash(values):
+    # Stable hash over parameter values, empty, None and NaN all count as ''
+    normalized = ['' if value is None or value != value else str(value) for value in values]
+    return hashlib.blake2b('\x1f'.join(normalized).encode(), digest_size=8).hexdigest()
+
+
+def _backfill_content_hash(conn):
+    conn.create_function('content_hash', len(PARAMETER_COLUMNS), lambda *values: content_hash(values),
+                         deterministic=True)
+    for table_name in ('changelog', 'changelog_latest'):
+        conn.execute(f"UPDATE {table_name} SET content_hash = content_hash({', '.join(PARAMETER_COLUMNS)})")
+
+
+# A delta row (changed_mask set) only holds the parameters whose bit is set, the others are the
+# same as in the row before. changelog_latest keeps full rows and counts the deltas since the last
+# full row, NULL when unknown.
+_latest_values = ', '.join(
+    f"CASE WHEN NEW.changed_mask IS NULL OR NEW.changed_mask & {PARAMETER_BITS[column]} THEN NEW.{column} "
+    f"ELSE (SELECT {column} FROM changelog_latest WHERE full_name = NEW.full_name) END"
+    if column in PARAMETER_BITS else f"NEW.{column}"
+    for column in CHANGELOG_COLUMNS)
+_rebuilt_values = ', '.join(
+    f"(SELECT {column} FROM changelog AS previous WHERE previous.full_name = OLD.full_name "
+    f"AND (previous.changed_mask IS NULL OR previous.changed_mask & {PARAMETER_BITS[column]}) "
+    f"ORDER BY timestamp DESC, rowid DESC LIMIT 1)"
+    if column in PARAMETER_BITS else column
+    for column in CHANGELOG_COLUMNS)
+
+
+# (version, statements), applied in order inside one transaction each, PRAGMA user_version holds the last one.
+# A statement can also be a function taking the connection.
+MIGRATIONS = [
+    (1, [
+        f"CREATE TABLE IF NOT EXISTS changelog ({', '.join(f'{column} TEXT' for column in CHANGELOG_COLUMNS)})",
+        "CREATE INDEX IF NOT EXISTS changelog_full_name_timestamp ON changelog (full_name, timestamp)",
+        "CREATE INDEX IF NOT EXISTS changelog_robot_name_schedule ON changelog (robot_name, schedule)",
+        "CREATE INDEX IF NOT EXISTS changelog_timestamp ON changelog (timestamp)",
+    ]),
+    (2, [
+        # Current state of every schedule, kept up to date by the triggers below
+        f"CREATE TABLE IF NOT EXISTS changelog_latest "
+        f"({', '.join(f'{column} TEXT' + (' PRIMARY KEY' if column == 'full_name' else '') for column in CHANGELOG_COLUMNS)})",
+        "CREATE INDEX IF NOT EXISTS changelog_latest_robot_name ON changelog_latest (robot_name)",
+        f"""
+        INSERT OR REPLACE INTO changelog_latest ({_columns})
+        SELECT {_columns} FROM (
+            SELECT *, ROW_NUMBER() OVER (PARTITION BY full_name ORDER BY timestamp DESC, rowid DESC) AS row_number
+            FROM changelog
+        ) WHERE row_number = 1
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS changelog_latest_insert AFTER INSERT ON changelog
+        WHEN NEW.timestamp >= COALESCE((SELECT timestamp FROM changelog_latest WHERE full_name = NEW.full_name), '')
+        BEGIN
+            INSERT OR REPLACE INTO changelog_latest ({_columns}) VALUES ({_new_values});
+        END
+        """,
+        # Deleting the latest row of a schedule falls back to the one before it
+        f"""
+        CREATE TRIGGER IF NOT EXISTS changelog_latest_delete AFTER DELETE ON changelog
+        WHEN EXISTS (SELECT 1 FROM changelog_latest WHERE full_name = OLD.full_name AND timestamp = OLD.timestamp)
+        BEGIN
+            DELETE FROM changelog_latest WHERE full_name = OLD.full_name;
+            INSERT INTO changelog_latest ({_columns})
+            SELECT {_columns} FROM changelog WHERE full_name = OLD.full_name
+            ORDER BY timestamp DESC, rowid DESC LIMIT 1;
+        END
+        """,
+    ]),
+    (3, [
+        "ALTER TABLE changelog ADD COLUMN content_hash TEXT",
+        "ALTER TABLE changelog_latest ADD COLUMN content_hash TEXT",
+        _backfill_content_hash,
+        "DROP TRIGGER changelog_latest_insert",
+        "DROP TRIGGER changelog_latest_delete",
+        f"""
+        CREATE TRIGGER changelog_latest_insert AFTER INSERT ON changelog
+        WHEN NEW.timestamp >= COALESCE((SELECT timestamp FROM changelog_latest WHERE full_name = NEW.full_name), '')
+        BEGIN
+            INSERT OR REPLACE INTO changelog_latest ({_columns}, content_hash) VALUES ({_new_values}, NEW.content_hash);
+        END
+        """,
+        f"""
+        CREATE TRIGGER changelog_latest_delete AFTER DELETE ON changelog
+        WHEN EXISTS (SELECT 1 FROM changelog_latest WHERE full_name = OLD.full_name AND timestamp = OLD.timestamp)
+        BEGIN
+            DELETE FROM changelog_latest WHERE full_name = OLD.full_name;
+            INSERT INTO changelog_latest ({_columns}, content_hash)
+            SELECT {_columns}, content_hash FROM changelog WHERE full_name = OLD.full_name
+            ORDER BY timestamp DESC, rowid DESC LIMIT 1;
+        END
+        """,
+    ]),
+    (4, [
+        # Polling plan of the background scanner, one row per robot schedule
+        """
+        CREATE TABLE IF NOT EXISTS scan_schedule (
+            full_name TEXT PRIMARY KEY,
+            robot_name TEXT,
+            schedule TEXT,
+            line_ip TEXT,
+            url TEXT,
+            interval REAL,
+            next_due REAL,
+            last_scanned TEXT,
+            last_changed TEXT
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS scan_schedule_next_due ON scan_schedule (next_due)",
+        "CREATE INDEX IF NOT EXISTS scan_schedule_robot_name ON scan_schedule (robot_name)",
+        # Robots someone is looking at in the UI, polled more often
+        "CREATE TABLE IF NOT EXISTS scan_focus (robot_name TEXT PRIMARY KEY, viewed_at REAL)",
+    ]),
+    (5, [
+        # Schedules found on each timer, 'live' or 'empty' as of checked_at
+        """
+        CREATE TABLE IF NOT EXISTS schedule_inventory (
+            robot_name TEXT,
+            schedule TEXT,
+            status TEXT,
+            checked_at REAL,
+            PRIMARY KEY (robot_name, schedule)
+        )
+        """,
+    ]),
+    (6, [
+        # One row per scan and its stage timings, see scan_metrics.py
+        """
+        CREATE TABLE IF NOT EXISTS scan_runs (
+            id INTEGER PRIMARY KEY,
+            source TEXT,
+            started_at TEXT,
+            wall_time REAL,
+            schedules INTEGER,
+            requests INTEGER,
+            changes INTEGER,
+            errors INTEGER,
+            skipped INTEGER,
+            cancelled INTEGER
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS scan_stages (
+            run_id INTEGER REFERENCES scan_runs (id),
+            stage TEXT,
+            host TEXT,
+            count INTEGER,
+            total_time REAL,
+            max_time REAL,
+            p50 REAL,
+            p95 REAL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS scan_stages_run_id ON scan_stages (run_id)",
+    ]),
+    (7, [
+        # Weld history downloaded from the timers, see weld_history.py
+        """
+        CREATE TABLE IF NOT EXISTS weld_history (
+            timer TEXT,
+            schedule TEXT,
+            record_key TEXT,
+            seq INTEGER,
+            order_value REAL,
+            ressumd REAL,
+            turnsratio NUMERIC,
+            data TEXT,
+            PRIMARY KEY (timer, schedule, record_key)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS weld_history_seq ON weld_history (timer, schedule, seq)",
+    ]),
+    (8, [
+        # Pages of one robot's changes, see changelog_view.py
+        "CREATE INDEX IF NOT EXISTS changelog_robot_name_timestamp ON changelog (robot_name, timestamp)",
+    ]),
+    (9, [
+        # Compact changelog storage, see changelog_delta.py
+        "ALTER TABLE changelog ADD COLUMN changed_mask INTEGER",
+        "ALTER TABLE changelog_latest ADD COLUMN deltas INTEGER DEFAULT 0",
+        "DROP TRIGGER changelog_latest_insert",
+        "DROP TRIGGER changelog_latest_delete",
+        f"""
+        CREATE TRIGGER changelog_latest_insert AFTER INSERT ON changelog
+        WHEN NEW.timestamp >= COALESCE((SELECT timestamp FROM changelog_latest WHERE full_name = NEW.full_name), '')
+        BEGIN
+            INSERT OR REPLACE INTO changelog_latest ({_columns}, content_hash, deltas)
+            VALUES ({_latest_values}, NEW.content_hash,
+                    CASE WHEN NEW.changed_mask IS NULL THEN 0
+                    ELSE (SELECT deltas FROM changelog_latest WHERE full_name = NEW.full_name) + 1 END);
+        END
+        """,
+        # The row falling back to latest may be a delta, every parameter comes from the last row holding it
+        f"""
+        CREATE TRIGGER changelog_latest_delete AFTER DELETE ON changelog
+        WHEN EXISTS (SELECT 1 FROM changelog_latest WHERE full_name = OLD.full_name AND timestamp = OLD.timestamp)
+        BEGIN
+            DELETE FROM changelog_latest WHERE full_name = OLD.full_name;
+            INSERT INTO changelog_latest ({_columns}, content_hash, deltas)
+            SELECT {_rebuilt_values}, content_hash, NULL FROM changelog WHERE full_name = OLD.full_name
+            ORDER BY timestamp DESC, rowid DESC LIMIT 1;
+        END
+        """,
+    ]),
+]
+
+_migrated = set()
+
+
+def migrate(db_file):
+    if db_file in _migrated:
+        return
+
+    conn = sqlite3.connect(db_file, isolation_level=None)
+    try:
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        for target, statements in MIGRATIONS:
+            if target <= version:
+                continue
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                for statement in statements:
+                    if callable(statement):
+                        statement(conn)
+                    else:
+                        conn.execute(statement)
+                conn.execute(f'PRAGMA user_version = {target}')
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            print(f"Migrated {db_file} to version {target}")
+    finally:
+        conn.close()
+
+    _migrated.add(db_file)
+
+
+# ------------benchmark-----------
+
+BENCHMARK_QUERIES = {
+    'schedule history': ("SELECT * FROM changelog WHERE full_name = ?", 'full_name'),
+    'latest record': ("SELECT * FROM changelog WHERE full_name = ? ORDER BY timestamp DESC LIMIT 1", 'full_name'),
+    'schedule dropdown': ("SELECT DISTINCT schedule FROM changelog WHERE robot_name = ?", 'robot_name'),
+    'last changes': ("SELECT * FROM changelog ORDER BY timestamp DESC LIMIT 5", None),
+    'robot changes page': ("SELECT * FROM changelog WHERE robot_name = ? ORDER BY timestamp DESC, rowid DESC LIMIT 21",
+                           'robot_name'),
+}
+
+
+def build_synthetic_changelog(db_file, rows, robots=400, schedules=40):
+    conn = sqlite3.connect(db_file)
+    conn.execute(MIGRATIONS[0][1][0])
+    rnd = random.Random(0)
+    robot_names = [f"FRM{rnd.randint(1, 2)}{n:03d}RB{rnd.randint(1, 9):02d}" for n in range(robots)]
+    start = time.mktime((2021, 1, 1, 0, 0, 0, 0, 0, -1))
+
+    data = []
+    for n in range(rows):
+        robot_name = rnd.choice(robot_names)
+        schedule = str(rnd.randint(1, schedules))
+        timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(start + n * 60))
+        values = [f"{rnd.randint(1, 99)}ms" for _ in CHANGELOG_COLUMNS[2:-2]]
+        data.append((robot_name, schedule, *values, robot_name + schedule, timestamp))
+
+    with conn:
+        conn.executemany(f"INSERT INTO changelog ({_columns}) VALUES ({', '.join('?' * len(CHANGELOG_COLUMNS))})", data)
+    conn.close()
+    return robot_names
+
+
+def time_queries(db_file, robot_names, repeat=20):
+    conn = sqlite3.connect(db_file)
+    rnd = random.Random(1)
+    timings = {}
+    for name, (query, param) in BENCHMARK_QUERIES.items():
+        start = time.perf_counter()
+        for _ in range(repeat):
+            robot_name = rnd.choice(robot_names)
+            params = {'full_name': (robot_name + str(rnd.randint(1, 40)),), 'robot_name': (robot_name,), None: ()}[param]
+            conn.execute(query, params).fetchall()
+        timings[name] = (time.perf_counter() - start) / repeat * 1000
+    conn.close()
+    return timings
+
+
+def time_queries_latest(db_file, robot_names, repeat=20):
+    # After the migration the current state comes from changelog_latest
+    conn = sqlite3.connect(db_file)
+    rnd = random.Random(1)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        full_name = rnd.choice(robot_names) + str(rnd.randint(1, 40))
+        conn.execute("SELECT * FROM changelog_latest WHERE full_name = ?", (full_name,)).fetchall()
+    conn.close()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def benchmark(rows):
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file = os.path.join(tmp, 'benchmark.db')
+        robot_names = build_synthetic_changelog(db_file, rows)
+        before = time_queries(db_file, robot_names)
+
+        start = time.perf_counter()
+        migrate(db_file)
+        migration_time = time.perf_counter() - start
+
+        after = time_queries(db_file, robot_names)
+        after['latest record'] = time_queries_latest(db_file, robot_names)
+
+    print(f"Synthetic changelog: {rows} rows, migration took {migration_time:.2f}s")
+    print(f"{'query':<20}{'before ms':>12}{'after ms':>12}{'speedup':>10}")
+    for name in BENCHMARK_QUERIES:
+        print(f"{name:<20}{before[name]:>12.3f}{after[name]:>12.3f}{before[name] / max(after[name], 1e-6):>9.0f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Migrate the changelog database schema")
+    parser.add_argument('db_file', nargs='?', default='db/database.db')
+    parser.add_argument('--benchmark', type=int, metavar='ROWS',
+                        help="time changelog queries before and after migrating a synthetic database")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(args.benchmark)
+    else:
+        migrate(args.db_file)
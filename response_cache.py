@@ -0,0 +1,128 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import requests
+
+import http_client
+
+# Process wide cache of timer API responses keyed by URL, shared by every Streamlit session.
+# A response is fresh for TTL seconds. For STALE_TTL seconds after that it's still returned right
+# away while a background request refreshes it. Once the cached bodies add up to more than
+# MAX_BYTES the least recently used responses are dropped (the parsed JSON takes a few times more).
+# Cached payloads are shared, callers must not modify them in place.
+TTL = 30
+STALE_TTL = 300
+MAX_BYTES = 64 * 2 ** 20
+
+# Threads refreshing stale responses and prefetching ones a page will probably ask for
+BACKGROUND_WORKERS = 8
+
+_lock = threading.Lock()
+_entries = OrderedDict()
+_inflight = {}
+_stats = {'hits': 0, 'stale_hits': 0, 'misses': 0, 'refreshes': 0, 'refresh_errors': 0, 'prefetches': 0,
+          'evictions': 0, 'bytes': 0}
+_background = ThreadPoolExecutor(max_workers=BACKGROUND_WORKERS, thread_name_prefix='response-cache')
+
+
+def store(url, payload, size):
+    with _lock:
+        old = _entries.pop(url, None)
+        if old is not None:
+            _stats['bytes'] -= old[2]
+        _entries[url] = (time.monotonic(), payload, size)
+        _stats['bytes'] += size
+        while _stats['bytes'] > MAX_BYTES and len(_entries) > 1:
+            _, (_, _, evicted_size) = _entries.popitem(last=False)
+            _stats['bytes'] -= evicted_size
+            _stats['evictions'] += 1
+
+
+def fetch(url, timeout=None):
+    # Downloads url into the cache. Only one request per URL runs at a time, concurrent callers
+    # wait for its result instead of sending their own.
+    with _lock:
+        future = _inflight.get(url)
+        owner = future is None
+        if owner:
+            future = _inflight[url] = Future()
+    if not owner:
+        return future.result()
+
+    try:
+        response = http_client.get(url, timeout=timeout)
+        response.raise_for_status()
+        payload = response.json()
+        store(url, payload, len(response.content))
+        future.set_result(payload)
+        return payload
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _lock:
+            _inflight.pop(url, None)
+
+
+def refresh(url, timeout=None):
+    try:
+        fetch(url, timeout)
+    except (requests.exceptions.RequestException, ValueError) as e:
+        # A stale response stays until it expires
+        with _lock:
+            _stats['refresh_errors'] += 1
+        print(f"Refreshing {url} failed: {e}")
+
+
+def get_json(url, timeout=None):
+    # Parsed JSON of url, raises like response.raise_for_status() when it has to be downloaded and that fails
+    with _lock:
+        entry = _entries.get(url)
+        age = None if entry is None else time.monotonic() - entry[0]
+        if age is None or age >= TTL + STALE_TTL:
+            _stats['misses'] += 1
+            entry = None
+        elif age < TTL:
+            _stats['hits'] += 1
+            _entries.move_to_end(url)
+            return entry[1]
+        else:
+            _stats['stale_hits'] += 1
+            _entries.move_to_end(url)
+            revalidate = url not in _inflight
+            if revalidate:
+                _stats['refreshes'] += 1
+
+    if entry is None:
+        return fetch(url, timeout)
+    if revalidate:
+        _background.submit(refresh, url, timeout)
+    return entry[1]
+
+
+def prefetch(urls, timeout=None):
+    # Starts downloading the urls that aren't cached and fresh, without waiting for them.
+    # A get_json for one of them meanwhile waits for that download instead of starting another.
+    now = time.monotonic()
+    with _lock:
+        missing = [url for url in dict.fromkeys(urls)
+                   if url not in _inflight and (url not in _entries or now - _entries[url][0] >= TTL)]
+        _stats['prefetches'] += len(missing)
+    for url in missing:
+        _background.submit(refresh, url, timeout)
+    return len(missing)
+
+
+def stats():
+    with _lock:
+        total = _stats['hits'] + _stats['stale_hits'] + _stats['misses']
+        return dict(_stats, entries=len(_entries),
+                    hit_rate=(_stats['hits'] + _stats['stale_hits']) / total if total else 0.0)
+
+
+def clear():
+    with _lock:
+        _entries.clear()
+        _stats['bytes'] = 0
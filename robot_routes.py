@@ -0,0 +1,79 @@
+import sqlite3
+
+import pandas as pd
+
+import db_cache
+
+# Where the timer of every robot is reached, worked out once from line_ips and ips and cached until
+# one of them changes, so building an API URL is a dict lookup. Both pages and the scanner use it.
+ROUTE_TABLES = ('line_ips', 'ips')
+
+# Lines with more than one controller, robots up to station SPLIT_STATION (robot_name[5]) are on
+# the first, the others on the second
+SPLIT_LINES = {'FRM1': ('FRM1_1', 'FRM1_2')}
+SPLIT_STATION = 3
+
+BASE_LINES = {group: line for line, groups in SPLIT_LINES.items() for group in groups}
+
+
+def line_group(line, robot_name):
+    # The line_ips entry of a robot on line, FRM1110RB01 is on FRM1_1
+    if line not in SPLIT_LINES:
+        return line
+    first, second = SPLIT_LINES[line]
+    return first if int(robot_name[5]) <= SPLIT_STATION else second
+
+
+def build(line_ips, robot_ips):
+    # {robot_name: route} in scan order, by controller in line_ips order and then in ips order.
+    # A robot is on the line its name starts with, robots without a line or controller are left out.
+    groups = dict(zip(line_ips['line'], line_ips['ip']))
+    lines = sorted({BASE_LINES.get(group, group) for group in groups}, key=len, reverse=True)
+    controller_order = {ip: n for n, ip in enumerate(pd.unique(line_ips['ip']))}
+
+    routes = {}
+    for robot_name, ip, robot_id in zip(robot_ips['robot_name'], robot_ips['ip'], robot_ips['robot_id']):
+        line = next((line for line in lines if robot_name.startswith(line)), None)
+        if line is None or robot_name in routes:
+            continue
+        try:
+            group = line_group(line, robot_name)
+        except (IndexError, ValueError):
+            print(f"No line controller for {robot_name}")
+            continue
+        if group not in groups:
+            continue
+
+        timer = f"{ip.replace('.', '_')}_{robot_id}"
+        routes[robot_name] = {'line': line, 'group': group, 'line_ip': groups[group], 'timer': timer,
+                              'prefix': f"http://{groups[group]}/4.1.0/timers/{timer}/"}
+
+    return dict(sorted(routes.items(), key=lambda item: controller_order[item[1]['line_ip']]))
+
+
+def read_routes(db_file):
+    conn = sqlite3.connect(db_file)
+    try:
+        line_ips = pd.read_sql_query("SELECT * FROM line_ips", conn)
+        robot_ips = pd.read_sql_query("SELECT * FROM ips", conn)
+    finally:
+        conn.close()
+    return build(line_ips, robot_ips)
+
+
+def current_version(db_file):
+    # Changes only when line_ips or ips do
+    return db_cache.table_version(db_file, ROUTE_TABLES)
+
+
+def load(db_file):
+    # Cached routes, callers must not modify them
+    return db_cache.load(db_file, 'robot_routes', lambda: read_routes(db_file), version=current_version(db_file))
+
+
+def schedule_url(route, schedule=''):
+    return f"{route['prefix']}schedule/{schedule}"
+
+
+def history_url(route, schedule):
+    return f"{route['prefix']}history/weld/schedule/{schedule}"
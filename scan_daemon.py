@@ -0,0 +1,285 @@
+import argparse
+import sqlite3
+import time
+from datetime import datetime
+
+import History
+import changelog_archive
+import http_client
+import migrations
+import scan_metrics
+
+# Headless scanner, polls every robot schedule on its own interval instead of waiting for a click
+# in the History page. Changed schedules are polled at MIN_INTERVAL, unchanged ones back off to
+# MAX_INTERVAL, robots viewed in the UI within FOCUS_WINDOW are capped at FOCUS_INTERVAL.
+MIN_INTERVAL = 60
+MAX_INTERVAL = 3600
+FOCUS_INTERVAL = 60
+FOCUS_WINDOW = 300
+
+# Global HTTP request budget and how often the schedule list is rebuilt from the targets
+REQUESTS_PER_MINUTE = 600
+PLAN_REFRESH = 600
+CYCLE_SLEEP = 1
+
+# Unknown schedules checked per idle cycle, discovery only runs when nothing is due
+DISCOVERY_BATCH = 16
+
+# Seconds between archive runs with --archive-days, see changelog_archive.py
+ARCHIVE_EVERY = 24 * 3600
+
+
+class RequestBudget:
+    # Token bucket, refills at requests_per_minute and holds at most burst tokens
+
+    def __init__(self, requests_per_minute, burst=None):
+        self.rate = requests_per_minute / 60
+        self.capacity = burst if burst is not None else max(requests_per_minute / 12, 2)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens
+
+    def take(self, count):
+        self.refill()
+        if self.tokens < count:
+            return False
+        self.tokens -= count
+        return True
+
+    def give_back(self, count):
+        self.tokens = min(self.capacity, self.tokens + count)
+
+
+def add_to_plan(db_file, plan, min_interval=MIN_INTERVAL, due_in=0, prune=False):
+    # Adds new robot schedules, due in due_in seconds, and keeps line ip and url of known ones current.
+    # prune drops the schedules missing from plan in the same transaction, returns how many.
+    next_due = time.time() + due_in
+    rows = [(r + str(s), r, s, l, api_url, min_interval, next_due) for l, r, api_url, s in plan]
+
+    conn = sqlite3.connect(db_file)
+    with conn:
+        conn.executemany('''
+            INSERT INTO scan_schedule (full_name, robot_name, schedule, line_ip, url, interval, next_due)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (full_name) DO UPDATE SET line_ip = excluded.line_ip, url = excluded.url
+        ''', rows)
+        stale = []
+        if prune:
+            planned = {row[0] for row in rows}
+            stale = [(full_name,) for full_name, in conn.execute("SELECT full_name FROM scan_schedule")
+                     if full_name not in planned]
+            conn.executemany("DELETE FROM scan_schedule WHERE full_name = ?", stale)
+    conn.close()
+    return len(stale)
+
+
+def refresh_plan(db_file, min_interval=MIN_INTERVAL):
+    # Polls the live schedules of every robot, returns the scan targets. Schedules of robots that left
+    # ips or turned empty in the inventory are dropped from the plan.
+    targets = History.scan_targets(db_file)
+    plan = History.scan_plan(db_file, targets)
+    dropped = add_to_plan(db_file, plan, min_interval, prune=True)
+    print(f"Scan plan refreshed, {len(plan)} schedules, {dropped} dropped")
+    return targets
+
+
+def focused_robots(conn, now, focus_window=FOCUS_WINDOW):
+    rows = conn.execute("SELECT robot_name FROM scan_focus WHERE viewed_at >= ?", (now - focus_window,))
+    return {row[0] for row in rows}
+
+
+def pick_due(db_file, now, limit, focus_interval=FOCUS_INTERVAL, focus_window=FOCUS_WINDOW):
+    # Due schedules, robots viewed in the UI first, then the most overdue
+    conn = sqlite3.connect(db_file)
+    focused = focused_robots(conn, now, focus_window)
+
+    if focused:
+        # A viewed robot that backed off is pulled forward to focus_interval after its last scan
+        placeholders = ', '.join('?' * len(focused))
+        with conn:
+            conn.execute(f'''
+                UPDATE scan_schedule
+                SET interval = MIN(interval, ?), next_due = MIN(next_due, next_due - interval + ?)
+                WHERE robot_name IN ({placeholders}) AND interval > ?
+            ''', (focus_interval, focus_interval, *focused, focus_interval))
+
+    placeholders = ', '.join('?' * len(focused)) or "''"
+    rows = conn.execute(f'''
+        SELECT full_name, robot_name, schedule, line_ip, url, interval FROM scan_schedule
+        WHERE next_due <= ?
+        ORDER BY robot_name IN ({placeholders}) DESC, next_due
+        LIMIT ?
+    ''', (now, *focused, limit)).fetchall()
+    conn.close()
+    return rows, focused
+
+
+def record_results(db_file, due, changed, focused, skipped=(), min_interval=MIN_INTERVAL,
+                   max_interval=MAX_INTERVAL, focus_interval=FOCUS_INTERVAL):
+    # Changed schedules go back to min_interval, unchanged ones double their interval,
+    # skipped ones (controller down) are retried once its circuit breaker closes
+    now = time.time()
+    scanned_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    changed = set(changed)
+    skipped = set(skipped)
+
+    retries = []
+    updates = []
+    for full_name, robot_name, _, _, _, interval in due:
+        if full_name in skipped:
+            retries.append((now + http_client.COOL_DOWN, full_name))
+            continue
+        if full_name in changed:
+            interval = min_interval
+        else:
+            interval = min(interval * 2, max_interval)
+        if robot_name in focused:
+            interval = min(interval, focus_interval)
+        updates.append((interval, now + interval, scanned_at, scanned_at if full_name in changed else None,
+                        full_name))
+
+    conn = sqlite3.connect(db_file)
+    with conn:
+        conn.executemany('''
+            UPDATE scan_schedule
+            SET interval = ?, next_due = ?, last_scanned = ?, last_changed = COALESCE(?, last_changed)
+            WHERE full_name = ?
+        ''', updates)
+        conn.executemany("UPDATE scan_schedule SET next_due = ? WHERE full_name = ?", retries)
+    conn.close()
+
+
+def scan(db_file, jobs, latest_hashes, workers, per_host_limit, source):
+    # scan_jobs with its timings saved to scan_runs
+    start = time.perf_counter()
+    metrics = scan_metrics.ScanMetrics()
+    stats = History.scan_jobs(db_file, jobs, latest_hashes, workers=workers, per_host_limit=per_host_limit,
+                              metrics=metrics)
+    stats['wall_time'] = time.perf_counter() - start
+    scan_metrics.save_run(db_file, source, stats, metrics)
+    return stats
+
+
+def run_cycle(db_file, budget, workers, per_host_limit, min_interval=MIN_INTERVAL, max_interval=MAX_INTERVAL,
+              max_jobs=256):
+    # One pass over the due schedules the budget allows, returns the scan stats or None when idle
+    now = time.time()
+    due, focused = pick_due(db_file, now, max_jobs)
+    if not due:
+        return None
+
+    latest_hashes = History.fetch_latest_hashes_from_db(db_file, 'changelog', {row[1] for row in due})
+
+    # A job costs two requests when the history check is needed, one otherwise
+    jobs = []
+    reserved = 0
+    for full_name, robot_name, schedule, line_ip, url, _ in due:
+        probe = full_name not in latest_hashes
+        cost = 2 if probe else 1
+        if not budget.take(cost):
+            break
+        reserved += cost
+        jobs.append((line_ip, robot_name, url, schedule, probe))
+
+    if not jobs:
+        return None
+    due = due[:len(jobs)]
+
+    stats = scan(db_file, jobs, latest_hashes, workers, per_host_limit, 'daemon')
+    budget.give_back(max(reserved - stats['requests'], 0))
+
+    record_results(db_file, due, stats['changed'], focused, stats['skipped_schedules'], min_interval, max_interval)
+    return stats
+
+
+def discover_cycle(db_file, targets, budget, workers, per_host_limit, min_interval=MIN_INTERVAL,
+                   batch=DISCOVERY_BATCH):
+    # Checks a few unknown or expired empty schedules, the live ones found join the plan
+    inventory = History.fetch_inventory(db_file)
+    now = time.time()
+
+    jobs = []
+    for l, r, selected_url in targets:
+        for s in History.discovery_schedules(inventory, r, now):
+            if len(jobs) >= batch or not budget.take(2):
+                break
+            jobs.append((l, r, selected_url + s, s, True))
+    if not jobs:
+        return None
+
+    latest_hashes = History.fetch_latest_hashes_from_db(db_file, 'changelog', {job[1] for job in jobs})
+    stats = scan(db_file, jobs, latest_hashes, workers, per_host_limit, 'discovery')
+    budget.give_back(max(2 * len(jobs) - stats['requests'], 0))
+
+    inventory = History.fetch_inventory(db_file, {job[1] for job in jobs})
+    live = [(l, r, api_url, s) for l, r, api_url, s, _ in jobs if inventory[r].get(s, (None,))[0] == 'live']
+    # Just scanned by discovery
+    add_to_plan(db_file, live, min_interval, due_in=min_interval)
+    stats['live'] = len(live)
+    return stats
+
+
+def run(db_file, requests_per_minute=REQUESTS_PER_MINUTE, workers=History.SCAN_WORKERS,
+        per_host_limit=History.PER_HOST_LIMIT, min_interval=MIN_INTERVAL, max_interval=MAX_INTERVAL, once=False,
+        archive_days=None):
+    migrations.migrate(db_file)
+    budget = RequestBudget(requests_per_minute)
+    planned_at = None
+    archived_at = None
+
+    while True:
+        if planned_at is None or time.monotonic() - planned_at >= PLAN_REFRESH:
+            targets = refresh_plan(db_file, min_interval)
+            planned_at = time.monotonic()
+
+        if archive_days is not None and (archived_at is None or time.monotonic() - archived_at >= ARCHIVE_EVERY):
+            archived_at = time.monotonic()
+            try:
+                changelog_archive.archive(db_file, archive_days)
+            except sqlite3.OperationalError as e:
+                # VACUUM needs the database to itself, the next run finishes it
+                print(f"Archiving failed: {e}")
+
+        start = time.perf_counter()
+        stats = run_cycle(db_file, budget, workers, per_host_limit, min_interval, max_interval)
+        if stats is not None:
+            print(f"Scanned {stats['schedules']} schedules in {time.perf_counter() - start:.1f}s, "
+                  f"{stats['requests']} requests, {stats['changes']} changes")
+            for l, skipped in stats['skipped'].items():
+                print(f"Skipped {skipped['schedules']} schedules on {l}: {skipped['reason']}")
+
+        if once:
+            return stats
+        if stats is None:
+            discovered = discover_cycle(db_file, targets, budget, workers, per_host_limit, min_interval)
+            if discovered is not None:
+                print(f"Discovery checked {discovered['schedules']} schedules, {discovered['live']} live")
+            else:
+                time.sleep(CYCLE_SLEEP)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scan the timers for schedule changes in the background")
+    parser.add_argument('--db', default='db/database.db')
+    parser.add_argument('--budget', type=int, default=REQUESTS_PER_MINUTE, help="HTTP requests per minute")
+    parser.add_argument('--workers', type=int, default=History.SCAN_WORKERS)
+    parser.add_argument('--per-host-limit', type=int, default=History.PER_HOST_LIMIT)
+    parser.add_argument('--min-interval', type=float, default=MIN_INTERVAL)
+    parser.add_argument('--max-interval', type=float, default=MAX_INTERVAL)
+    parser.add_argument('--once', action='store_true', help="run a single scan cycle and exit")
+    parser.add_argument('--profile', metavar='PATH', help="write a cProfile dump of the main thread on exit")
+    parser.add_argument('--archive-days', type=int, metavar='DAYS',
+                        help="once a day, move changelog rows older than DAYS to the Parquet archive")
+    args = parser.parse_args()
+
+    try:
+        with scan_metrics.profiled(args.profile):
+            run(args.db, args.budget, args.workers, args.per_host_limit, args.min_interval, args.max_interval,
+                args.once, args.archive_days)
+    except KeyboardInterrupt:
+        pass
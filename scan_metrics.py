@@ -0,0 +1,169 @@
+import cProfile
+import pstats
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+# Timers and counters of one scan, saved to scan_runs / scan_stages (migration 6).
+# Stage times are summed over all worker threads, so http can add up to more than the wall time.
+STAGES = ['plan', 'http', 'json', 'decode', 'diff', 'save']
+
+# The scanner daemon saves a run every cycle, only the latest KEEP_RUNS are kept
+KEEP_RUNS = 5000
+
+
+class ScanMetrics:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        self.timings = {}
+        # ThreadProfiles while the scan is profiled, see profiled
+        self.profiles = None
+
+    def add(self, stage, seconds, host=None):
+        with self.lock:
+            self.timings.setdefault((stage, host), []).append(seconds)
+
+    @contextmanager
+    def timer(self, stage, host=None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start, host)
+
+    def percentiles(self, stage, q=(50, 95, 99)):
+        # Over all hosts, None when the stage never ran
+        with self.lock:
+            values = [value for (name, _), timings in self.timings.items() if name == stage for value in timings]
+        if not values:
+            return None
+        return dict(zip(q, np.percentile(values, q).tolist()))
+
+    def summary(self):
+        # One row per stage, http also per host
+        with self.lock:
+            timings = {key: np.array(values) for key, values in self.timings.items()}
+        return [(stage, host, len(values), float(values.sum()), float(values.max()),
+                 float(np.percentile(values, 50)), float(np.percentile(values, 95)))
+                for (stage, host), values in timings.items()]
+
+
+def timer(metrics, stage, host=None):
+    # metrics.timer, or nothing when the scan isn't instrumented
+    if metrics is None:
+        return nullcontext()
+    return metrics.timer(stage, host)
+
+
+class ThreadProfiles:
+    # One cProfile.Profile per worker thread, enabled only while the thread runs a job of the scan
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.profiles = []
+
+    @contextmanager
+    def job(self):
+        profile = getattr(self.local, 'profile', None)
+        if profile is None:
+            profile = self.local.profile = cProfile.Profile()
+            with self.lock:
+                self.profiles.append(profile)
+        try:
+            profile.enable()
+        except ValueError:
+            # Python 3.12+ profiles every thread from the calling one and allows a single profiler
+            yield
+            return
+        try:
+            yield
+        finally:
+            profile.disable()
+
+
+def profiled_job(metrics):
+    # Profiles a job on a worker thread when the scan is profiled
+    if metrics is None or metrics.profiles is None:
+        return nullcontext()
+    return metrics.profiles.job()
+
+
+def save_run(db_file, source, stats, metrics):
+    conn = sqlite3.connect(db_file)
+    with conn:
+        cursor = conn.execute('''
+            INSERT INTO scan_runs (source, started_at, wall_time, schedules, requests, changes, errors, skipped,
+                                   cancelled)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (source, metrics.started_at, stats['wall_time'], stats['schedules'], stats['requests'],
+              stats['changes'], stats['errors'], len(stats['skipped_schedules']), int(stats['cancelled'])))
+        run_id = cursor.lastrowid
+        conn.executemany("INSERT INTO scan_stages VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                         [(run_id, *row) for row in metrics.summary()])
+        conn.execute("DELETE FROM scan_stages WHERE run_id <= ?", (run_id - KEEP_RUNS,))
+        conn.execute("DELETE FROM scan_runs WHERE id <= ?", (run_id - KEEP_RUNS,))
+    conn.close()
+    return run_id
+
+
+def fetch_runs(db_file, source=None, limit=50):
+    # Last runs (of one source) with the time of every stage as a column
+    conn = sqlite3.connect(db_file)
+    where = '' if source is None else 'WHERE source = ?'
+    params = () if source is None else (source,)
+    runs = pd.read_sql_query(f"SELECT * FROM scan_runs {where} ORDER BY id DESC LIMIT ?", conn,
+                             params=params + (limit,))
+    stages = pd.read_sql_query(f'''
+        SELECT run_id, stage, SUM(total_time) AS total_time FROM scan_stages
+        WHERE run_id IN (SELECT id FROM scan_runs {where} ORDER BY id DESC LIMIT ?)
+        GROUP BY run_id, stage
+    ''', conn, params=params + (limit,))
+    conn.close()
+
+    stages = stages.pivot(index='run_id', columns='stage', values='total_time')
+    stages = stages.reindex(columns=STAGES).fillna(0.0)
+    return runs.set_index('id').join(stages).sort_index()
+
+
+def fetch_hosts(db_file, run_id):
+    # HTTP latency per host of one run
+    conn = sqlite3.connect(db_file)
+    df = pd.read_sql_query('''
+        SELECT host, count AS requests, p50, p95, max_time FROM scan_stages
+        WHERE run_id = ? AND stage = 'http'
+        ORDER BY p95 DESC
+    ''', conn, params=(run_id,))
+    conn.close()
+    return df
+
+
+@contextmanager
+def profiled(path, metrics=None):
+    # cProfile dump of the calling thread to path, nothing when path is None. With metrics the
+    # worker threads of the scan are profiled as well and merged into the same dump.
+    if path is None:
+        yield
+        return
+    if metrics is not None:
+        metrics.profiles = ThreadProfiles()
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        stats = pstats.Stats(profile)
+        if metrics is not None:
+            with metrics.profiles.lock:
+                stats.add(*metrics.profiles.profiles)
+            metrics.profiles = None
+        stats.dump_stats(path)
+        print(f"Profile written to {path}")
@@ -0,0 +1,188 @@
+import argparse
+import io
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import pandas as pd
+import requests
+
+import History
+import http_client
+import robot_routes
+import scan_metrics
+import spot_data
+import weld_history
+
+# Batch mode of the Spot Data page: parameters of a whole list of point names in one table.
+# Every (robot, schedule) is fetched once however many points share it, BATCH_WORKERS at a time and
+# at most PER_HOST_LIMIT at a time per line controller.
+#   python spot_batch.py points.csv spots.parquet
+BATCH_WORKERS = 8
+PER_HOST_LIMIT = History.PER_HOST_LIMIT
+
+SPOT_COLUMNS = ['Point Name', 'Line', 'RobotName', 'ProgNr', 'Manufacturor', 'Thickness', 'Material',
+                'PartThickness', 'Part Tolerance', 'Force']
+HISTORY_COLUMNS = ['welds', 'turnsratio', 'ressumd_last', 'ressumd_mean']
+
+
+def timer_urls(spot, routes):
+    # (timer, history url, schedule url) of a spot_data row, KeyError when its robot has no route
+    route = routes[History.format_robot_name(spot['RobotName'])]
+    return (route['timer'], robot_routes.history_url(route, spot['ProgNr']),
+            robot_routes.schedule_url(route, spot['ProgNr']))
+
+
+def read_point_names(file):
+    # Point names of an uploaded CSV, from its Point Name column or else its first column.
+    # Without a header the first line is a point name as well. Duplicates are dropped, an empty file has none.
+    try:
+        df = pd.read_csv(file, dtype=str)
+    except pd.errors.EmptyDataError:
+        return []
+    if 'Point Name' in df.columns:
+        names = df['Point Name']
+    else:
+        names = pd.concat([pd.Series([df.columns[0]]), df.iloc[:, 0]], ignore_index=True)
+    names = names.dropna().str.strip()
+    return list(dict.fromkeys(names[names != '']))
+
+
+def resolve(point_names, merged_df, routes):
+    # One row per point name with its spot data, robot_name, schedule and URLs. status is 'not found'
+    # for names missing from the spot data and 'no timer' when their line or robot has no address.
+    spots = merged_df[merged_df['Point Name'].isin(point_names)].drop_duplicates('Point Name')
+    spots = pd.DataFrame({'Point Name': pd.Series(point_names, dtype=str)}).merge(spots, on='Point Name', how='left')
+    # Names that weren't found would turn the integer columns into floats
+    spots = spots.astype({column: 'Int64' for column in spot_data.INT_COLUMNS})
+
+    rows = []
+    for _, spot in spots.iterrows():
+        if pd.isna(spot['RobotName']):
+            rows.append((None, None, None, None, None, 'not found'))
+            continue
+        try:
+            timer, history_url, api = timer_urls(spot, routes)
+        except KeyError:
+            rows.append((None, None, None, None, None, 'no timer'))
+            continue
+        rows.append((History.format_robot_name(spot['RobotName']), str(spot['ProgNr']), timer, history_url, api,
+                     None))
+    columns = ['robot_name', 'schedule', 'timer', 'history_url', 'api', 'status']
+    spots[columns] = pd.DataFrame(rows, index=spots.index, columns=columns)
+    return spots
+
+
+def history_summary(history_df):
+    # Weld count, latest turns ratio and resistance of a downloaded history
+    if history_df is None or history_df.empty:
+        return dict.fromkeys(HISTORY_COLUMNS)
+    order_column = next((column for column in weld_history.ORDER_COLUMNS if column in history_df.columns), None)
+    if order_column is not None:
+        history_df = history_df.sort_values(order_column, kind='stable')
+    last = history_df.iloc[-1]
+    ressumd = pd.to_numeric(history_df['ressumd'], errors='coerce') if 'ressumd' in history_df.columns else None
+    return {'welds': len(history_df), 'turnsratio': last.get('turnsratio'),
+            'ressumd_last': None if ressumd is None else ressumd.iloc[-1],
+            'ressumd_mean': None if ressumd is None else ressumd.mean()}
+
+
+def fetch_spot(history_url, api, metrics=None):
+    # (raw schedule rows or None, history summary, status) of one timer schedule
+    host = http_client.host_of(api)
+    if not http_client.host_available(host):
+        return None, history_summary(None), 'skipped'
+    try:
+        schedule_df = History.request_data_from_api(api, 'schedule', metrics=metrics)
+        # An empty schedule has no welds either
+        if schedule_df is None:
+            return None, history_summary(None), 'empty'
+        history_df = History.request_data_from_api(history_url, 'history', metrics=metrics)
+    except requests.exceptions.RequestException as e:
+        print(f"Error fetching data from {api}: {e}")
+        return None, history_summary(None), 'skipped' if not http_client.host_available(host) else 'error'
+    return schedule_df, history_summary(history_df), 'ok'
+
+
+def lookup(spots, workers=BATCH_WORKERS, per_host_limit=PER_HOST_LIMIT, progress=None):
+    # Fetches and decodes the spots of resolve, returns (table, stats). progress is called with
+    # (schedules done, schedules) after every fetched schedule.
+    start = time.perf_counter()
+    metrics = scan_metrics.ScanMetrics()
+    unique = spots[spots['status'].isna()].drop_duplicates(['robot_name', 'schedule'])
+    jobs = History.interleave_hosts(zip(unique['robot_name'], unique['schedule'], unique['history_url'], unique['api']),
+                                    host=lambda job: http_client.host_of(job[3]))
+    host_limits = {http_client.host_of(api): threading.BoundedSemaphore(per_host_limit) for *_, api in jobs}
+
+    def run(job):
+        _, _, history_url, api = job
+        with host_limits[http_client.host_of(api)]:
+            return fetch_spot(history_url, api, metrics)
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(run, job): job[:2] for job in jobs}
+        for done, future in enumerate(as_completed(futures), 1):
+            results[futures[future]] = future.result()
+            if progress is not None:
+                progress(done, len(jobs))
+
+    # Decoded together, one row per (robot, schedule)
+    raw = [raw_df.astype(object).assign(robot_name=r, schedule=s)
+           for (r, s), (raw_df, _, _) in results.items() if raw_df is not None]
+    with metrics.timer('decode'):
+        decoded = History.reformat_batch(pd.concat(raw, ignore_index=True)) if raw else pd.DataFrame(
+            columns=['robot_name', 'schedule'])
+    fetched = pd.DataFrame([(r, s, status, *summary.values()) for (r, s), (_, summary, status) in results.items()],
+                           columns=['robot_name', 'schedule', 'fetch_status'] + HISTORY_COLUMNS)
+    fetched = fetched.merge(decoded, on=['robot_name', 'schedule'], how='left')
+
+    table = spots.merge(fetched, on=['robot_name', 'schedule'], how='left')
+    table['status'] = table['status'].fillna(table['fetch_status'])
+    table['welds'] = table['welds'].astype('Int64')
+    parameters = [column for column in decoded.columns if column not in ('robot_name', 'schedule')]
+    table = table[['Point Name', 'status'] + SPOT_COLUMNS[1:] + parameters + HISTORY_COLUMNS]
+
+    wall_time = time.perf_counter() - start
+    http = metrics.percentiles('http')
+    counts = table['status'].value_counts()
+    stats = {'points': len(spots), 'resolved': int(spots['status'].isna().sum()), 'schedules': len(jobs),
+             'requests': sum(len(timings) for (stage, _), timings in metrics.timings.items() if stage == 'http'),
+             'ok': int(counts.get('ok', 0)), 'errors': int(counts.get('error', 0)),
+             'skipped': int(counts.get('skipped', 0)), 'wall_time': wall_time,
+             'points_per_second': len(spots) / wall_time if wall_time else 0.0,
+             'http_p50': http[50] if http else None, 'http_p95': http[95] if http else None}
+    stats['requests_per_second'] = stats['requests'] / wall_time if wall_time else 0.0
+    print(f"Looked up {stats['points']} points ({stats['resolved']} resolved, {stats['schedules']} schedules) "
+          f"in {wall_time:.1f}s, {stats['requests']} requests ({stats['requests_per_second']:.1f}/s), "
+          f"{stats['errors']} errors, {stats['skipped']} skipped")
+    return table, stats
+
+
+def to_csv(table):
+    return table.to_csv(index=False).encode()
+
+
+def to_parquet(table):
+    # Mixed object columns are written as text, missing values stay null
+    table = table.copy()
+    for column in table.columns[table.dtypes == object]:
+        table[column] = table[column].map(lambda value: None if value is None or value != value else str(value))
+    buffer = io.BytesIO()
+    table.to_parquet(buffer, index=False)
+    return buffer.getvalue()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Look up the timer parameters of a list of point names")
+    parser.add_argument('points', help="CSV with a Point Name column, or the names in its first column")
+    parser.add_argument('output', help="table to write, .parquet or .csv")
+    parser.add_argument('--db-file', default='db/database.db')
+    parser.add_argument('--workers', type=int, default=BATCH_WORKERS)
+    args = parser.parse_args()
+
+    merged_df = spot_data.load_spot_data(args.db_file)
+    spots = resolve(read_point_names(args.points), merged_df, robot_routes.load(args.db_file))
+    table, _ = lookup(spots, workers=args.workers)
+    with open(args.output, 'wb') as f:
+        f.write(to_parquet(table) if args.output.endswith('.parquet') else to_csv(table))
@@ -0,0 +1,160 @@
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+# Merged sw_summary + thickness ("spot data"), materialized in the spot_data table and only
+# rebuilt for rows whose source rows changed
+SOURCE_TABLES = ('sw_summary', 'thickness')
+CATEGORY_COLUMNS = ['Line', 'RobotName', 'Manufacturor']
+INT_COLUMNS = ['ProgNr', 'Force', 'Part Tolerance']
+KEY_COLUMNS = ['sw_rowid', 'thickness_rowid']
+
+
+def transform_spot_data(merged_df):
+    merged_df = merged_df.copy()
+    thickness_material = merged_df['total_thk_mat'].str.split('//', expand=True).reindex(columns=[0, 1])
+    merged_df[['Thickness', 'Material']] = thickness_material.fillna('No data')
+    merged_df['Thickness'] = merged_df['Thickness'].astype(str).str.replace(',', '.')
+    merged_df[INT_COLUMNS] = merged_df[INT_COLUMNS].fillna(0)
+    merged_df[INT_COLUMNS] = merged_df[INT_COLUMNS].astype('int')
+    return merged_df
+
+
+def ensure_change_triggers(conn, tables=SOURCE_TABLES):
+    # Every write to a source table bumps its version, so unchanged sources cost one lookup
+    conn.execute("CREATE TABLE IF NOT EXISTS source_versions (table_name TEXT PRIMARY KEY, version INTEGER)")
+    for table_name in tables:
+        for operation in ('INSERT', 'UPDATE', 'DELETE'):
+            conn.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS {table_name}_version_{operation.lower()}
+                AFTER {operation} ON {table_name}
+                BEGIN
+                    INSERT INTO source_versions VALUES ('{table_name}', 1)
+                    ON CONFLICT (table_name) DO UPDATE SET version = version + 1;
+                END
+            ''')
+
+
+def has_change_triggers(conn, tables=SOURCE_TABLES):
+    names = [f"{table_name}_version_{operation}" for table_name in tables
+             for operation in ('insert', 'update', 'delete')]
+    count = conn.execute(f"SELECT count(*) FROM sqlite_master WHERE type = 'trigger' "
+                         f"AND name IN ({', '.join('?' * len(names))})", names).fetchone()[0]
+    return count == len(names) and table_exists(conn, 'source_versions')
+
+
+def source_fingerprint(conn, tables=SOURCE_TABLES):
+    # Writes are counted by the change triggers, so no table is read. Replacing a source table drops
+    # its triggers, which changes the fingerprint as well.
+    parts = []
+    for table_name in tables:
+        schema = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?",
+                              (table_name,)).fetchone()
+        triggers = conn.execute("SELECT count(*) FROM sqlite_master WHERE type = 'trigger' AND tbl_name = ?",
+                                (table_name,)).fetchone()[0]
+        version = None
+        if table_exists(conn, 'source_versions'):
+            version = conn.execute("SELECT version FROM source_versions WHERE table_name = ?",
+                                   (table_name,)).fetchone()
+        parts.append(f"{table_name}:{schema[0] if schema else ''}:{triggers}:{version}")
+    return '|'.join(parts)
+
+
+def table_exists(conn, table_name):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                        (table_name,)).fetchone() is not None
+
+
+def read_merged_sources(conn):
+    sw_df = pd.read_sql_query("SELECT rowid AS sw_rowid, * FROM sw_summary ORDER BY rowid", conn)
+    thickness_df = pd.read_sql_query("SELECT rowid AS thickness_rowid, * FROM thickness ORDER BY rowid", conn)
+
+    merged_df = pd.merge(sw_df, thickness_df, left_on='Point Name', right_on='point_id', how='left')
+    merged_df['thickness_rowid'] = merged_df['thickness_rowid'].fillna(0).astype('int64')
+
+    source_columns = [column for column in merged_df.columns if column not in KEY_COLUMNS]
+    merged_df['source_hash'] = pd.util.hash_pandas_object(merged_df[source_columns], index=False).values.view('int64')
+    return merged_df
+
+
+def refresh(db_file):
+    # Returns number of spot rows written, 0 when the sources haven't changed
+    conn = sqlite3.connect(db_file)
+    try:
+        conn.execute("CREATE TABLE IF NOT EXISTS spot_data_meta (name TEXT PRIMARY KEY, value TEXT)")
+        stored = conn.execute("SELECT value FROM spot_data_meta WHERE name = 'fingerprint'").fetchone()
+        if stored is not None and table_exists(conn, 'spot_data') and stored[0] == source_fingerprint(conn):
+            return 0
+
+        merged_df = read_merged_sources(conn)
+
+        if table_exists(conn, 'spot_data'):
+            stored_df = pd.read_sql_query("SELECT sw_rowid, thickness_rowid, source_hash FROM spot_data", conn)
+            stored_columns = [row[1] for row in conn.execute("PRAGMA table_info(spot_data)")]
+        else:
+            stored_df = None
+            stored_columns = []
+
+        new_columns = list(transform_spot_data(merged_df.head(0)).columns)
+
+        with conn:
+            if stored_df is None or stored_columns != new_columns:
+                # First build or the source schema changed
+                changed_df = merged_df
+                conn.execute("DROP TABLE IF EXISTS spot_data")
+            else:
+                compared = merged_df[KEY_COLUMNS + ['source_hash']].merge(
+                    stored_df, on=KEY_COLUMNS, how='outer', suffixes=('', '_stored'), indicator=True)
+                changed = compared[(compared['_merge'] == 'left_only') |
+                                   ((compared['_merge'] == 'both') &
+                                    (compared['source_hash'] != compared['source_hash_stored']))]
+                removed = compared[compared['_merge'] == 'right_only']
+
+                stale_keys = pd.concat([changed, removed])[KEY_COLUMNS].astype('int64').itertuples(index=False)
+                conn.executemany("DELETE FROM spot_data WHERE sw_rowid = ? AND thickness_rowid = ?",
+                                 [tuple(map(int, key)) for key in stale_keys])
+
+                changed_df = merged_df.merge(changed[KEY_COLUMNS], on=KEY_COLUMNS)
+
+            if not changed_df.empty or stored_df is None or stored_columns != new_columns:
+                transform_spot_data(changed_df).to_sql('spot_data', conn, if_exists='append', index=False)
+            conn.execute("CREATE INDEX IF NOT EXISTS spot_data_order ON spot_data (sw_rowid, thickness_rowid)")
+
+            ensure_change_triggers(conn)
+            conn.execute("INSERT OR REPLACE INTO spot_data_meta VALUES ('fingerprint', ?)",
+                         (source_fingerprint(conn),))
+
+        print(f"Spot data refreshed, {len(changed_df)} of {len(merged_df)} rows rebuilt")
+        return len(changed_df)
+    finally:
+        conn.close()
+
+
+def current_version(db_file):
+    # Changes only when the spot data sources do, unlike the database wide data_version. Refreshes
+    # first, the first refresh installs the triggers and so changes the fingerprint.
+    refresh(db_file)
+    conn = sqlite3.connect(db_file)
+    try:
+        return source_fingerprint(conn)
+    finally:
+        conn.close()
+
+
+def load_spot_data(db_file):
+    refresh(db_file)
+
+    conn = sqlite3.connect(db_file)
+    df = pd.read_sql_query("SELECT * FROM spot_data ORDER BY sw_rowid, thickness_rowid", conn)
+    conn.close()
+
+    df = df.drop(columns=KEY_COLUMNS + ['source_hash']).fillna(np.nan)
+
+    # Compact dtypes, the text columns repeat a handful of values
+    for column in CATEGORY_COLUMNS:
+        df[column] = df[column].astype('category')
+    for column in INT_COLUMNS:
+        df[column] = pd.to_numeric(df[column], downcast='integer')
+
+    return df
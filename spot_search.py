@@ -0,0 +1,112 @@
+import bisect
+from collections import defaultdict
+
+import numpy as np
+
+# Exact, prefix and substring search over point names. Matching ignores case and treats the
+# term as plain text, so IDs like 1608441-S-0750 need no escaping.
+EXACT, PREFIX, SUBSTRING = 0, 1, 2
+VERIFY_THRESHOLD = 256
+CANDIDATE_CHUNK = 4096
+
+
+# Postings are kept for substrings up to this long, shorter search terms look up their own posting list
+GRAM_SIZE = 3
+
+
+def ngrams(text, n=GRAM_SIZE):
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+class SpotSearchIndex:
+
+    def __init__(self, point_names):
+        # Unique names, each with the row positions it appears at
+        self.names = []
+        self.rows = []
+        name_ids = {}
+        for position, name in enumerate(point_names):
+            if not isinstance(name, str):
+                continue
+            key = name.casefold()
+            if key not in name_ids:
+                name_ids[key] = len(self.names)
+                self.names.append(key)
+                self.rows.append([])
+            self.rows[name_ids[key]].append(position)
+
+        self.name_ids = name_ids
+        self.sorted_names = sorted(name_ids)
+
+        postings = defaultdict(list)
+        for name_id, name in enumerate(self.names):
+            for n in range(1, GRAM_SIZE + 1):
+                for gram in ngrams(name, n):
+                    postings[gram].append(name_id)
+        self.postings = {gram: np.array(ids, dtype=np.int32) for gram, ids in postings.items()}
+
+    def __len__(self):
+        return len(self.names)
+
+    def _prefix_matches(self, term, limit):
+        matches = []
+        for index in range(bisect.bisect_left(self.sorted_names, term), len(self.sorted_names)):
+            name = self.sorted_names[index]
+            if not name.startswith(term) or len(matches) >= limit:
+                break
+            if name != term:
+                matches.append(self.name_ids[name])
+        return matches
+
+    def _substring_candidates(self, term):
+        # Yields name ids that contain all trigrams of term, in chunks so a common term
+        # stops early instead of intersecting every posting list in full. A shorter term is a
+        # posting list of its own.
+        lists = []
+        for gram in ngrams(term, min(len(term), GRAM_SIZE)):
+            ids = self.postings.get(gram)
+            if ids is None:
+                return
+            lists.append(ids)
+        lists.sort(key=len)
+
+        for start in range(0, len(lists[0]), CANDIDATE_CHUNK):
+            candidates = lists[0][start:start + CANDIDATE_CHUNK]
+            for ids in lists[1:]:
+                # Once few candidates are left, checking them directly is cheaper than intersecting
+                if len(candidates) <= VERIFY_THRESHOLD:
+                    break
+                # Posting lists are sorted, so a binary search per candidate does the intersection
+                found = ids[np.minimum(np.searchsorted(ids, candidates), len(ids) - 1)] == candidates
+                candidates = candidates[found]
+            yield from candidates.tolist()
+
+    def search(self, term, limit=50):
+        # Returns (row positions, ranks) ordered exact, prefix, substring, then by row position
+        term = term.strip().casefold()
+        if not term:
+            return [], []
+
+        ranked = []
+        seen = set()
+
+        exact = self.name_ids.get(term)
+        if exact is not None:
+            ranked.append((EXACT, exact))
+            seen.add(exact)
+
+        for name_id in self._prefix_matches(term, limit):
+            ranked.append((PREFIX, name_id))
+            seen.add(name_id)
+
+        substring = []
+        for name_id in self._substring_candidates(term):
+            if len(ranked) + len(substring) >= limit:
+                break
+            if name_id not in seen and term in self.names[name_id]:
+                substring.append((SUBSTRING, name_id))
+        ranked.extend(substring)
+
+        results = sorted((rank, position) for rank, name_id in ranked[:limit] for position in self.rows[name_id])
+        results = results[:limit]
+        return [position for _, position in results], [rank for rank, _ in results]
@@ -1,19 +1,26 @@
 import re
-import sqlite3
 
 import pandas as pd
 import requests
 import streamlit as st
 from pandas import json_normalize
 
+import db_cache
+import migrations
+import response_cache
+import robot_routes
+import spot_batch
+import spot_data
+import weld_history
+from spot_search import SpotSearchIndex
+
 st.set_page_config(page_title="Weld tracker", page_icon=":sparkles:", layout="wide")
 
+SEARCH_LIMIT = 50
 
-def read_data_from_db(db_file, table_name):
-    conn = sqlite3.connect(db_file)
-    df = pd.read_sql_query(f"SELECT * FROM {table_name}", conn)
-    conn.close()
-    return df
+# When a search matches several spots, the timer data of this many of them is fetched in the
+# background so picking another match doesn't wait for the timers
+PREFETCH_SPOTS = 5
 
 
 def format_robot_name(robot_name):
@@ -40,11 +47,10 @@ def printer(filtered_df):
 
     return api
 
-def fetch_data_from_api(url, data_type, timeout=1):
+def fetch_data_from_api(url, data_type, timeout=None):
     try:
-        response = requests.get(url, timeout=timeout)
-        response.raise_for_status()  # Raises an HTTPError for bad responses (4xx, 5xx)
-        data = response.json()
+        # Shared between sessions, repeated lookups within response_cache.TTL don't reach the timer
+        data = response_cache.get_json(url, timeout=timeout)
 
         # Convert the data to a DataFrame if possible
         df = json_normalize(data, data_type)
@@ -60,28 +66,74 @@ def fetch_data_from_api(url, data_type, timeout=1):
         return None
 
 
+def prefetch_spots(spots, routes):
+    # Starts fetching schedule and history of the spots concurrently, skips spots without a known timer
+    urls = []
+    for _, spot in spots.iterrows():
+        try:
+            _, history_url, api = spot_batch.timer_urls(spot, routes)
+        except KeyError:
+            continue
+        urls += [api, history_url]
+    response_cache.prefetch(urls)
+
+
+def batch_lookup(merged_df, routes):
+    # Parameters of an uploaded list of point names, kept in the session so downloading doesn't fetch again
+    uploaded = st.file_uploader("Point names (CSV):", type='csv')
+    if uploaded is not None and st.button("Look up"):
+        point_names = spot_batch.read_point_names(uploaded)
+        if not point_names:
+            st.warning("No point names found in the uploaded file")
+            return
+        spots = spot_batch.resolve(point_names, merged_df, routes)
+        bar = st.progress(0.0, text="Fetching schedules")
+        st.session_state['batch'] = spot_batch.lookup(
+            spots, progress=lambda done, total: bar.progress(done / total, text=f"Fetched {done} of {total} schedules"))
+        bar.empty()
+
+    if 'batch' not in st.session_state:
+        return
+    table, stats = st.session_state['batch']
+    st.dataframe(table, hide_index=True)
+
+    csv_column, parquet_column = st.columns([1, 1])
+    with csv_column:
+        st.download_button("Download CSV", spot_batch.to_csv(table), file_name='spots.csv', mime='text/csv')
+    with parquet_column:
+        st.download_button("Download Parquet", spot_batch.to_parquet(table), file_name='spots.parquet',
+                           mime='application/octet-stream')
+
+    st.write(f"{stats['points']} points, {stats['resolved']} resolved to {stats['schedules']} schedules, "
+             f"{stats['ok']} with parameters, {stats['errors']} errors, {stats['skipped']} skipped")
+    st.write(f"{stats['requests']} requests in {stats['wall_time']:.1f}s, "
+             f"{stats['requests_per_second']:.1f} requests/s, {stats['points_per_second']:.1f} points/s"
+             + (f", HTTP p50 {stats['http_p50'] * 1000:.0f} ms / p95 {stats['http_p95'] * 1000:.0f} ms"
+                if stats['http_p50'] is not None else ''))
+
+
 # ------------main-----------
 
 def main():
 
-    # Load data
+    # Load data, cached across reruns until the database changes
     db_file = "db/database.db"
-    df = read_data_from_db(db_file, "sw_summary")
-    thickness_df = read_data_from_db(db_file, "thickness")
-    weld_data_df = read_data_from_db(db_file, "weld_data")
-    line_ips = read_data_from_db(db_file, 'line_ips')
-    robot_ips = read_data_from_db(db_file, 'ips')
+    migrations.migrate(db_file)
+    routes = robot_routes.load(db_file)
 
-    merged_df = pd.merge(df, thickness_df, left_on='Point Name', right_on='point_id', how='left')
-    merged_df[['Thickness', 'Material']] = merged_df['total_thk_mat'].str.split('//', expand=True).fillna('No data')
-    merged_df['Thickness'] = merged_df['Thickness'].str.replace(',', '.')
-    merged_df[['ProgNr', 'Force', 'Part Tolerance']] = merged_df[['ProgNr', 'Force', 'Part Tolerance']].fillna(0)
-    merged_df[['ProgNr', 'Force', 'Part Tolerance']] = merged_df[['ProgNr', 'Force', 'Part Tolerance']].astype('int')
+    spot_version = spot_data.current_version(db_file)
+    merged_df = db_cache.load(db_file, 'spot_data', lambda: spot_data.load_spot_data(db_file), version=spot_version)
+    search_index = db_cache.load(db_file, 'spot_search', lambda: SpotSearchIndex(merged_df['Point Name']),
+                                 version=spot_version)
 
 
     # Header
     st.header('Spot Data')
 
+    if st.sidebar.radio("Mode:", ['Search', 'Batch']) == 'Batch':
+        batch_lookup(merged_df, routes)
+        return
+
     # Input for search
     search_term = st.text_input("Search:",
                                 placeholder="Enter spot ID")
@@ -90,47 +142,46 @@ def main():
     # Filtering data based on the search term
     if search_term:
 
-        # Filtering merged df based on point name
-        filtered_df = merged_df[merged_df['Point Name'].str.contains(search_term, na=False)]
+        # Filtering merged df based on point name, exact and prefix matches first
+        positions, _ = search_index.search(search_term, limit=SEARCH_LIMIT)
+        filtered_df = merged_df.iloc[positions]
+
+        if filtered_df.empty:
+            st.warning(f"No spot found for {search_term}")
+            return
 
 
         if filtered_df.shape[0] > 1:
             st.write(filtered_df[['Point Name', 'ProgNr']])
+            labels = [f"{name} (ProgNr {schedule})" for name, schedule in zip(filtered_df['Point Name'], filtered_df['ProgNr'])]
+            choice = st.selectbox("Spot:", range(len(labels)), format_func=labels.__getitem__, key=f"spot_{search_term}")
+
+            # The picked spot's schedule and history download alongside the other candidates'
+            prefetch_spots(pd.concat([filtered_df.iloc[[choice]], filtered_df.head(PREFETCH_SPOTS)]), routes)
+            filtered_df = filtered_df.iloc[[choice]]
 
 
         # Filtering data for api url
-        line_name = filtered_df['Line'].iloc[0]
-        robot_name = format_robot_name(filtered_df['RobotName'].iloc[0])
-        if line_name == 'FRM1':
-            if int(robot_name[5]) <= 3:
-                line_name = 'FRM1_1'
-            elif int(robot_name[5]) > 3:
-                line_name = 'FRM1_2'
-
-        line = line_ips['ip'][line_ips['line'] == line_name].iloc[0]
-        robot_ip = robot_ips['ip'][robot_ips['robot_name'] == robot_name].iloc[0].replace('.','_')
-        robot_id = robot_ips['robot_id'][robot_ips['robot_name'] == robot_name].iloc[0]
+        try:
+            timer, history_url, api = spot_batch.timer_urls(filtered_df.iloc[0], routes)
+        except KeyError:
+            st.warning(f"No timer address for robot {filtered_df.iloc[0]['RobotName']}")
+            return
         schedule_numb = filtered_df['ProgNr'].iloc[0]
 
-        # API history link
-        history_url = f"http://{line}/4.1.0/timers/{robot_ip}_{robot_id}/history/weld/schedule/{schedule_numb}"
-
-        # API schedule link
-        api = f"http://{line}/4.1.0/timers/{robot_ip}_{robot_id}/schedule/{schedule_numb}"
-
-        # History df
-        weld_data_filtered = fetch_data_from_api(history_url, 'history')
+        # History df, new records are added to the local store at most every HISTORY_REFRESH seconds
+        weld_history.sync(db_file, timer, str(schedule_numb), lambda: fetch_data_from_api(history_url, 'history'))
+        weld_data_filtered = weld_history.load(db_file, timer, str(schedule_numb))
 
         # columns
         left_column, middle_column, right_column = st.columns([2, 2, 2])
 
         # get response
-        response = requests.get(api)
-
-        if response.status_code == 200:
-            data = response.json()
-        else:
-            st.write(f"Failed to retrieve data: {response.status_code}")
+        try:
+            data = response_cache.get_json(api)
+        except requests.exceptions.RequestException as e:
+            st.write(f"Failed to retrieve data: {e}")
+            return
 
         # converting to df
         schedule_df = json_normalize(data, 'schedule')
@@ -184,7 +235,7 @@ def main():
 
             st.markdown(
                 f"<span style='font-size:20px;'><b>Turns ratio:</b>"
-                f" <span style='color:{color};'>{weld_data_filtered.iloc[0]['turnsratio'] if not weld_data_df.empty else 'N/A'}</span>",
+                f" <span style='color:{color};'>{weld_data_filtered.iloc[-1]['turnsratio'] if not weld_data_filtered.empty else 'N/A'}</span>",
                 unsafe_allow_html=True
             )
 
@@ -347,11 +398,19 @@ def main():
         # Resistance sum D
 
         if not weld_data_filtered['ressumd'].eq(0).all():
-            d_sum_data = weld_data_filtered['ressumd'].tolist()
             st.subheader("Resistance sum D")
-            amount_input = st.slider("Choose amount of data which you want to display:", 0,100,(50))
+            amount_input = st.slider("Choose amount of data which you want to display:", 1,
+                                     max(len(weld_data_filtered), 2), min(50, len(weld_data_filtered)))
+
+            # Latest welds, downsampled so long histories still draw quickly
+            d_sum_data = weld_history.downsample(weld_data_filtered.tail(amount_input))
+            st.line_chart(d_sum_data.set_index('seq')['ressumd'])
+
+    with st.sidebar.expander("Cache stats"):
+        st.write(db_cache.stats())
 
-            st.line_chart(d_sum_data[:amount_input])
+    with st.sidebar.expander("Timer response cache"):
+        st.write(response_cache.stats())
 
 
 
@@ -0,0 +1,133 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+# Local copy of the timers' weld history (weld_history table, migration 7), so a rerun of the
+# Spot Data page reads sqlite instead of downloading the whole history again.
+# Records are ordered by the first ORDER_COLUMNS field the timer sends, only records newer than the
+# last stored one are added. Without such a field records are told apart by a hash of their content
+# and kept in the order they first arrived.
+ORDER_COLUMNS = ['weldid', 'timestamp']
+
+# Seconds before the same timer schedule is downloaded again
+HISTORY_REFRESH = 30
+
+# Points drawn in the resistance chart at most
+MAX_POINTS = 1000
+
+_lock = threading.Lock()
+_fetched_at = {}
+
+
+def record_key(record):
+    return hashlib.blake2b(json.dumps(record, sort_keys=True, default=str).encode(), digest_size=8).hexdigest()
+
+
+def stored_state(conn, timer, schedule):
+    # (last order value, last seq) of a timer schedule
+    return conn.execute('''
+        SELECT MAX(order_value), COALESCE(MAX(seq), 0) FROM weld_history WHERE timer = ? AND schedule = ?
+    ''', (timer, schedule)).fetchone()
+
+
+def new_records(df, last_order, conn, timer, schedule):
+    # Records of df that aren't stored yet, oldest first, with their order values
+    order_column = next((column for column in ORDER_COLUMNS if column in df.columns), None)
+
+    if order_column is not None:
+        order = pd.to_numeric(df[order_column], errors='coerce')
+        if order.notna().all():
+            df = df.assign(_order=order.to_numpy()).sort_values('_order', kind='stable')
+            if last_order is not None:
+                df = df[df['_order'] > last_order]
+            order_values = df.pop('_order').tolist()
+            return df.to_dict('records'), order_values
+
+    stored = {row[0] for row in conn.execute(
+        "SELECT record_key FROM weld_history WHERE timer = ? AND schedule = ?", (timer, schedule))}
+    records = [record for record in df.to_dict('records') if record_key(record) not in stored]
+    return records, [None] * len(records)
+
+
+def store(db_file, timer, schedule, df):
+    # Appends the records of a downloaded history that are new, returns how many
+    if df is None or df.empty:
+        return 0
+
+    conn = sqlite3.connect(db_file)
+    try:
+        last_order, last_seq = stored_state(conn, timer, schedule)
+        records, order_values = new_records(df, last_order, conn, timer, schedule)
+        rows = [(timer, schedule, record_key(record), last_seq + n + 1, order_value,
+                 record.get('ressumd'), record.get('turnsratio'), json.dumps(record, default=str))
+                for n, (record, order_value) in enumerate(zip(records, order_values))]
+        with conn:
+            conn.executemany("INSERT OR IGNORE INTO weld_history VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        return len(rows)
+    finally:
+        conn.close()
+
+
+def sync(db_file, timer, schedule, fetch, force=False):
+    # fetch downloads the full history as a DataFrame (or None), called at most every HISTORY_REFRESH
+    # seconds per timer schedule and process. Returns the number of new records.
+    key = (db_file, timer, schedule)
+    with _lock:
+        if not force and time.monotonic() - _fetched_at.get(key, -HISTORY_REFRESH) < HISTORY_REFRESH:
+            return 0
+        _fetched_at[key] = time.monotonic()
+    return store(db_file, timer, schedule, fetch())
+
+
+def load(db_file, timer, schedule):
+    # Stored history, oldest first
+    conn = sqlite3.connect(db_file)
+    df = pd.read_sql_query('''
+        SELECT seq, order_value, ressumd, turnsratio FROM weld_history
+        WHERE timer = ? AND schedule = ?
+        ORDER BY seq
+    ''', conn, params=(timer, schedule))
+    conn.close()
+    return df
+
+
+def lttb(x, y, threshold=MAX_POINTS):
+    # Largest-Triangle-Three-Buckets, keeps the first and last point and from every bucket in between
+    # the point forming the largest triangle with the previous pick and the next bucket's average.
+    # Returns the indexes of the kept points.
+    n = len(y)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    edges = np.linspace(1, n - 1, threshold - 1).astype(int)
+    kept = np.empty(threshold, dtype=int)
+    kept[0] = 0
+    kept[-1] = n - 1
+
+    previous = 0
+    for bucket in range(threshold - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        next_start, next_end = end, edges[bucket + 2] if bucket + 2 < len(edges) else n
+        next_x = x[next_start:next_end].mean()
+        next_y = y[next_start:next_end].mean()
+
+        areas = np.abs((x[previous] - next_x) * (y[start:end] - y[previous])
+                       - (x[previous] - x[start:end]) * (next_y - y[previous]))
+        previous = start + int(np.argmax(areas))
+        kept[bucket + 1] = previous
+    return kept
+
+
+def downsample(df, column='ressumd', threshold=MAX_POINTS):
+    # df reduced to at most threshold rows for charting, by LTTB over seq and column
+    values = df[column].to_numpy(dtype=float)
+    if np.isnan(values).any():
+        df = df[~np.isnan(values)]
+    return df.iloc[lttb(df['seq'].to_numpy(), df[column].to_numpy(dtype=float), threshold)]